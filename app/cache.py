@@ -1,40 +1,175 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import datetime
 import json
+import multiprocessing
+import time
 
+import django
 import pandas as pd
 
+from django.conf import settings
 from django.core.cache import cache
 
-def rebuild_caches():
-    from . import reports
+# Reports cached for each kind of period
+PERIOD_REPORTS = {
+    'year': [
+        'api_top_noticias',
+        'api_top_proposicoes',
+        'enquetes_temas',
+        'proposicoes_temas',
+        'noticias_temas',
+        'noticias_tags',
+        'api_relatorio_consolidado',
+        'relatorio_consolidado',
+    ],
+    'month': [
+        'api_top_noticias',
+        'api_top_proposicoes',
+        'relatorio_consolidado',
+    ],
+    'day': [
+        'api_top_noticias',
+        'api_top_proposicoes',
+    ],
+}
+
+# Cache keys of the progress of the last rebuild
+PROGRESS_CACHE_NAME = 'rebuild_caches-progress'
+TOTAL_CACHE_NAME = 'rebuild_caches-total'
+
+def cache_periods():
+    """
+    Returns the (kind, initial_date, final_date) periods whose reports are
+    cached: every year, month and day since 2019, most recent first. Dates
+    are ISO strings so that periods can be sent to celery tasks.
+    """
+    periods = []
 
     for year_start in pd.date_range(start='2019-01-01', end=datetime.date.today(), freq='YS').sort_values(ascending=False):
         year_end = year_start.replace(month=12, day=31)
-        year_start = year_start.to_pydatetime().date()
-        year_end = year_end.to_pydatetime().date()
-
-        reports.api_top_noticias(initial_date=year_start, final_date=year_end, save_cache=True)
-        reports.api_top_proposicoes(initial_date=year_start, final_date=year_end, save_cache=True)
-        reports.enquetes_temas(initial_date=year_start, final_date=year_end, save_cache=True)
-        reports.proposicoes_temas(initial_date=year_start, final_date=year_end, save_cache=True)
-        reports.noticias_temas(initial_date=year_start, final_date=year_end, save_cache=True)
-        reports.noticias_tags(initial_date=year_start, final_date=year_end, save_cache=True)
-        reports.api_relatorio_consolidado(initial_date=year_start, final_date=year_end, save_cache=True)
-        reports.relatorio_consolidado(initial_date=year_start, final_date=year_end, save_cache=True)
+        periods.append(('year', year_start.date().isoformat(), year_end.date().isoformat()))
 
     for month_start in pd.date_range(start='2019-01-01', end=datetime.date.today(), freq='MS').sort_values(ascending=False):
         month_end = month_start.replace(day=month_start.days_in_month)
+        periods.append(('month', month_start.date().isoformat(), month_end.date().isoformat()))
 
-        month_start = month_start.to_pydatetime().date()
-        month_end = month_end.to_pydatetime().date()
+    for day in pd.date_range(start='2019-01-01', end=datetime.date.today()).sort_values(ascending=False):
+        periods.append(('day', day.date().isoformat(), day.date().isoformat()))
 
-        reports.api_top_noticias(initial_date=month_start, final_date=month_end, save_cache=True)
-        reports.api_top_proposicoes(initial_date=month_start, final_date=month_end, save_cache=True)
-        reports.relatorio_consolidado(initial_date=month_start, final_date=month_end, save_cache=True)
+    return periods
 
-    for day in pd.date_range(start='2019-01-01', end=datetime.date.today()).sort_values(ascending=False):
-        day = day.to_pydatetime().date()
+def warm_cache_period(period):
+    from . import reports
+
+    kind, initial_date, final_date = period
+    initial_date = datetime.date.fromisoformat(initial_date)
+    final_date = datetime.date.fromisoformat(final_date)
+
+    for report in PERIOD_REPORTS[kind]:
+        getattr(reports, report)(initial_date=initial_date, final_date=final_date, save_cache=True)
+
+def warm_cache_periods(periods):
+    """
+    Warms the cache of each period, counting them in the progress counter.
+    Returns the periods that failed, so that one failure doesn't stop the
+    others.
+    """
+    failed = []
+
+    for period in periods:
+        try:
+            warm_cache_period(period)
+            error = None
+        except Exception as e:
+            error = e
+            failed.append(period)
+
+        try:
+            progress = '{}/{}'.format(cache.incr(PROGRESS_CACHE_NAME), cache.get(TOTAL_CACHE_NAME))
+        except ValueError:
+            # The counter expired or was never started
+            progress = '?'
+
+        if error:
+            print('Failed to warm cache for {} {}-{} ({}): {!r}'.format(*period, progress, error))
+        else:
+            print('Warmed cache for {} {}-{} ({})'.format(*period, progress))
+
+    return failed
+
+def start_progress(total):
+    cache.set(PROGRESS_CACHE_NAME, 0, None)
+    cache.set(TOTAL_CACHE_NAME, total, None)
+
+def get_progress():
+    """
+    Returns the (warmed, total) periods of the last rebuild.
+    """
+    return cache.get(PROGRESS_CACHE_NAME, 0), cache.get(TOTAL_CACHE_NAME, 0)
+
+def report_rebuild(started_at, failed):
+    print('Rebuilt caches for {} periods in {:.0f}s ({} failed)'.format(
+        get_progress()[1], time.time() - started_at, len(failed)))
+
+    for period in failed:
+        print('Failed: {} {}-{}'.format(*period))
+
+def rebuild_caches(concurrency=None):
+    """
+    Warms the cache of every period (see cache_periods) on this machine, on
+    CACHE_WARMING_CONCURRENCY processes (or concurrency). Daemonic processes
+    (like celery's prefork workers) can't have children, so there, or with a
+    concurrency of 1, periods are warmed one after another instead.
+    """
+    concurrency = concurrency or settings.CACHE_WARMING_CONCURRENCY
+    started_at = time.time()
+    periods = cache_periods()
+    start_progress(len(periods))
+
+    if concurrency <= 1 or multiprocessing.current_process().daemon:
+        failed = warm_cache_periods(periods)
+    else:
+        failed = []
+
+        # Processes are spawned rather than forked so that they don't share
+        # the database and cache connections of this one
+        with ProcessPoolExecutor(concurrency, mp_context=multiprocessing.get_context('spawn'), initializer=django.setup) as executor:
+            futures = [executor.submit(warm_cache_periods, [period]) for period in periods]
+
+            for future in as_completed(futures):
+                failed += future.result()
+
+    report_rebuild(started_at, failed)
+
+def enqueue_rebuild_caches(concurrency=None):
+    """
+    Warms the cache of every period (see cache_periods) on the celery
+    workers: periods are dealt round-robin into CACHE_WARMING_CONCURRENCY (or
+    concurrency) tasks of a group, so that at most that many run at once and
+    each gets a mix of long (yearly) and short (daily) periods. A chord
+    callback reports completion.
+
+    Returns the AsyncResult of the chord (see wait_rebuild_caches).
+    """
+    from celery import chord
+    from core import tasks
+
+    periods = cache_periods()
+    concurrency = min(concurrency or settings.CACHE_WARMING_CONCURRENCY, len(periods))
+    start_progress(len(periods))
+
+    return chord(
+        [tasks.warm_cache_periods_task.s(periods[i::concurrency]) for i in range(concurrency)]
+    )(tasks.rebuild_caches_done_task.s(time.time()))
 
-        reports.api_top_noticias(initial_date=day, final_date=day, save_cache=True)
-        reports.api_top_proposicoes(initial_date=day, final_date=day, save_cache=True)
+def wait_rebuild_caches(result, interval=10):
+    """
+    Waits for the chord returned by enqueue_rebuild_caches, printing the
+    progress every interval seconds.
+    """
+    while not result.ready():
+        print('Warmed cache for {}/{} periods'.format(*get_progress()))
+        time.sleep(interval)
 
+    result.get()
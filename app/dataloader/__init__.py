@@ -2,5 +2,6 @@ from .comentariosportal import *
 from .dadosabertos import *
 from .enquetes import *
 from .googleanalytics import *
+from .noticias import *
 from .preprocessor import *
 from .prisma import *
@@ -1,67 +1,107 @@
 from django.conf import settings
 from django.db import connections, models, transaction, IntegrityError
 
+import datetime
 import tenacity
 
 from .common import *
 
 @tenacity.retry(**TENACITY_ARGUMENTS)
 @transaction.atomic
-def load_comentarios_portal():
+def load_comentarios_portal(full=None):
+    """
+    Loads the comentarios and their posicionamentos (reactions). By default
+    only the comentarios and posicionamentos since the latest data already
+    loaded are fetched (posicionamentos being matched on id_comentario and
+    usuario_id), and the comentarios of the last
+    DATALOADER_COMENTARIOS_PENDING_DAYS days still PENDENTE are fetched again
+    so that moderation reaches them. Every DATALOADER_FULL_SYNC_DAYS days (or
+    with full) both tables are reloaded from scratch instead.
+    """
     if 'comentarios_portal' not in settings.DATABASES:
         print('Comentarios portal connection not available')
         return
- 
+
+    if full is None:
+        full = full_sync_due('comentarios_portal')
+
+    if full:
+        load_comentarios_portal_full()
+        record_full_sync('comentarios_portal')
+    else:
+        load_comentarios_portal_incremental()
+
+def load_comentarios_portal_full():
     with connections['default'].cursor() as cursor:
-        # model_mappings follow this format: (source_table_name, model)
-        models_list = [ 
-            get_model('PortalComentario'),
-            get_model('PortalComentarioPosicionamento'),
+        replicated_tables = [
+            ReplicatedTable(get_model('PortalComentario')),
+            ReplicatedTable(get_model('PortalComentarioPosicionamento')),
         ]
 
-        for model in models_list:
-            target_table_name = model._meta.db_table
-
-            cursor.execute('ALTER TABLE public."%s" DISABLE TRIGGER ALL;' % (target_table_name,))
-            cursor.execute('DELETE FROM public."%s"' % (target_table_name,))
-
-            instance_list = []
-
-            source_field_list = []
-            target_field_list = []
-            has_local_id = False
-            for field in model._meta.fields:
-                if field.name == 'local_id':
-                    has_local_id = True
-                elif isinstance(field, models.ForeignKey):
-                    source_field_list.append(field.name)
-                    target_field_list.append('{}_id'.format(field.name))
-                else:
-                    source_field_list.append(field.name)
-                    target_field_list.append(field.name)
-
-            if has_local_id:
-                # TODO: This needs to be yielded using a qs, like the alternative below, to avoid memory issues.
-                instance_list = []
-                for row in connections['comentarios_portal'].cursor() \
-                    .execute('SELECT {} FROM "{}"'.format(', '.join(source_field_list), model._meta.db_table)):
-
-                    # import pdb;pdb.set_trace()
-                    instance_list.append(
-                        model(**dict(zip(target_field_list, row)))
-                    )
-                model.objects.using('default').bulk_create(instance_list)
-            else:
-                for _, _, _, qs in batch_qs(model.objects.using('comentarios_portal')):
-                    instance_list = []
-
-                    for instance_values in qs.values(*target_field_list):
-                        instance_list.append(
-                            model(**instance_values)
-                        )
-
-                    model.objects.using('default').bulk_create(instance_list)
-
-            cursor.execute('ALTER TABLE public."%s" ENABLE TRIGGER ALL;' % (target_table_name,))
-
-            print('Loaded %s' % (target_table_name,))
+        # Columns that feed NoticiaAggregated
+        fingerprint_args = ('data', ['url', 'situacao'])
+        fingerprints_before = date_fingerprints(cursor, get_model('PortalComentario')._meta.db_table, *fingerprint_args)
+
+        with replicate_tables(cursor, 'comentarios_portal', replicated_tables) as target_tables:
+            fingerprints_after = date_fingerprints(cursor, target_tables[get_model('PortalComentario')], *fingerprint_args)
+            mark_dirty_dates(['noticias'], changed_dates(fingerprints_before, fingerprints_after))
+
+# SQL Server takes at most 2100 parameters per query
+COMENTARIOS_IDS_PER_QUERY = 1000
+
+def load_comentarios_portal_incremental():
+    comentario_model = get_model('PortalComentario')
+    posicionamento_model = get_model('PortalComentarioPosicionamento')
+
+    pending_since = datetime.datetime.now() - datetime.timedelta(days=settings.DATALOADER_COMENTARIOS_PENDING_DAYS)
+
+    with connections['default'].cursor() as cursor, \
+         live_tables(cursor, [comentario_model, posicionamento_model]) as target_tables:
+
+        comentario_table = target_tables[comentario_model]
+        posicionamento_table = target_tables[posicionamento_model]
+
+        last_comentario = local_watermark(cursor, comentario_table, 'data') or datetime.datetime(1900, 1, 1)
+        last_posicionamento = local_watermark(cursor, posicionamento_table, 'data') or datetime.datetime(1900, 1, 1)
+
+        cursor.execute('SELECT "id" FROM public."{}" WHERE "situacao" = %s AND "data" >= %s'.format(comentario_table),
+            ['PENDENTE', pending_since])
+        pending_ids = [id for id, in cursor.fetchall()]
+
+        # Comentarios fetched again (new ones are added after the load)
+        touched_where = ('"data" >= %s OR "id" = ANY(%s)', [last_comentario, pending_ids])
+
+        cursor.execute('SELECT "id", "situacao" FROM public."{}" WHERE {}'.format(comentario_table, touched_where[0]), touched_where[1])
+        situacoes_before = dict(cursor.fetchall())
+
+        fingerprint_args = (comentario_table, 'data', ['url', 'situacao'], *touched_where)
+        fingerprints_before = date_fingerprints(cursor, *fingerprint_args)
+
+        posicionamentos_before = local_count(cursor, posicionamento_table, '"data" >= %s', [last_posicionamento])
+
+        comentario_update_columns = [field.column for field in comentario_model._meta.concrete_fields if not field.primary_key]
+
+        replicate_table(cursor, 'comentarios_portal', ReplicatedTable(comentario_model), comentario_table,
+            '"data" >= %s', [last_comentario], update_columns=comentario_update_columns)
+
+        for start in range(0, len(pending_ids), COMENTARIOS_IDS_PER_QUERY):
+            chunk = pending_ids[start:start + COMENTARIOS_IDS_PER_QUERY]
+            replicate_table(cursor, 'comentarios_portal', ReplicatedTable(comentario_model), comentario_table,
+                '"id" IN ({})'.format(', '.join(['%s'] * len(chunk))), chunk, update_columns=comentario_update_columns)
+
+        replicate_table(cursor, 'comentarios_portal', ReplicatedTable(posicionamento_model), posicionamento_table,
+            '"data" >= %s', [last_posicionamento], update_columns=['usuario_nome', 'data', 'favor'],
+            conflict_columns=['id_comentario', 'usuario_id'])
+
+        cursor.execute('SELECT "id", "situacao" FROM public."{}" WHERE {}'.format(comentario_table, touched_where[0]), touched_where[1])
+        situacoes_after = dict(cursor.fetchall())
+
+        mark_dirty_dates(['noticias'], changed_dates(fingerprints_before, date_fingerprints(cursor, *fingerprint_args)))
+
+        new_posicionamentos = local_count(cursor, posicionamento_table, '"data" >= %s', [last_posicionamento]) - posicionamentos_before
+
+    new_comentarios = len(situacoes_after.keys() - situacoes_before.keys())
+    status_changes = sum(1 for id, situacao in situacoes_before.items() if situacoes_after.get(id, situacao) != situacao)
+
+    print('Loaded comentarios portal incrementally: %d new comentarios, %d status changes (%d pending re-checked), %d new posicionamentos' % (
+        new_comentarios, status_changes, len(pending_ids), new_posicionamentos))
@@ -1,8 +1,24 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import collections
+import contextlib
+import datetime
+import functools
+import hashlib
+import io
+import json
 import logging
+import multiprocessing
 import sys
 import tenacity
+import threading
+import time
+
+import django
 
 from django.apps import apps
+from django.conf import settings
+from django.db import connections, transaction, IntegrityError
 
 # Models need to be imported like this in order to avoid cyclic import issues with celery
 def get_model(model_name):
@@ -23,6 +39,35 @@ TENACITY_ARGUMENTS_FAST = {
     'wait': tenacity.wait_exponential(multiplier=30),
     'before_sleep': tenacity.before_sleep_log(logger, logging.ERROR, exc_info=True)
 }
+
+class TokenBucket:
+    """
+    Thread safe token bucket rate limiter: acquire() blocks until a token is
+    available. Tokens are refilled at rate per second, up to capacity (rate
+    by default), so bursts never go over the quota.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
 def batch_qs(qs, batch_size=50000):
     """
     Returns a (start, end, total, queryset) tuple for each batch in the given
@@ -34,6 +79,153 @@ def batch_qs(qs, batch_size=50000):
         end = min(start + batch_size, total)
         yield (start, end, total, qs[start:end])
 
+def copy_value(value):
+    """
+    Formats a Python value as a field of PostgreSQL's COPY text format.
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        value = value.isoformat()
+    elif isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    else:
+        value = str(value)
+
+    return value \
+        .replace('\\', '\\\\') \
+        .replace('\t', '\\t') \
+        .replace('\n', '\\n') \
+        .replace('\r', '\\r')
+
+class CopyStream(io.TextIOBase):
+    """
+    Read-only file object that renders an iterable of row tuples as COPY text
+    lazily, so that only a small buffer is ever held in memory.
+    """
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.row_count = 0
+        self.buffer = ''
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        chunks = [self.buffer]
+        length = len(self.buffer)
+
+        while size < 0 or length < size:
+            try:
+                row = next(self.rows)
+            except StopIteration:
+                break
+
+            line = '\t'.join(copy_value(value) for value in row) + '\n'
+            chunks.append(line)
+            length += len(line)
+            self.row_count += 1
+
+        data = ''.join(chunks)
+        if size < 0:
+            self.buffer = ''
+            return data
+
+        self.buffer = data[size:]
+        return data[:size]
+
+def copy_rows(cursor, table_name, columns, rows, conflict_columns=None, update_columns=None):
+    """
+    Streams rows (an iterable of tuples following the order of columns) into
+    table_name with COPY ... FROM STDIN. The full data set is never built in
+    memory nor rendered as SQL.
+
+    When conflict_columns is given, rows are copied into a temporary table and
+    merged with INSERT ... ON CONFLICT (conflict_columns), either DO NOTHING
+    or DO UPDATE SET update_columns.
+
+    Returns the number of rows read from rows.
+    """
+    start_time = time.perf_counter()
+    quoted_columns = ', '.join('"%s"' % (column,) for column in columns)
+    stream = CopyStream(rows)
+
+    if conflict_columns:
+        temp_table_name = 'copy_%s' % (table_name.lower(),)
+
+        cursor.execute('CREATE TEMPORARY TABLE "{}" AS SELECT {} FROM public."{}" WITH NO DATA'.format(
+            temp_table_name, quoted_columns, table_name))
+        cursor.copy_expert('COPY "{}" ({}) FROM STDIN'.format(temp_table_name, quoted_columns), stream)
+
+        if update_columns:
+            conflict_action = 'DO UPDATE SET ' + ', '.join('"{0}" = EXCLUDED."{0}"'.format(column) for column in update_columns)
+        else:
+            conflict_action = 'DO NOTHING'
+
+        cursor.execute('INSERT INTO public."{}" ({}) SELECT {} FROM "{}" ON CONFLICT ({}) {}'.format(
+            table_name, quoted_columns, quoted_columns, temp_table_name,
+            ', '.join('"%s"' % (column,) for column in conflict_columns), conflict_action))
+        cursor.execute('DROP TABLE "{}"'.format(temp_table_name))
+    else:
+        cursor.copy_expert('COPY public."{}" ({}) FROM STDIN'.format(table_name, quoted_columns), stream)
+
+    elapsed = time.perf_counter() - start_time
+    print('Copied %d rows into %s in %.1fs (%d rows/s)' % (
+        stream.row_count, table_name, elapsed, stream.row_count / elapsed if elapsed else 0))
+
+    return stream.row_count
+
+def row_hash(row):
+    """
+    md5 of a row tuple, as rendered in COPY text format.
+    """
+    return hashlib.md5('\t'.join(copy_value(value) for value in row).encode()).hexdigest()
+
+def upsert_changed_rows(cursor, table_name, columns, rows, hash_column='row_hash'):
+    """
+    Upserts rows (an iterable of tuples following the order of columns, the
+    first column being the primary key) into table_name, storing row_hash()
+    of each one in hash_column. Existing rows are only updated when their
+    stored hash differs, so unchanged rows are never rewritten.
+
+    Returns an (inserted, updated, unchanged) tuple of counts.
+    """
+    start_time = time.perf_counter()
+    temp_table_name = 'upsert_%s' % (table_name.lower(),)
+    all_columns = list(columns) + [hash_column]
+    quoted_columns = ', '.join('"%s"' % (column,) for column in all_columns)
+    stream = CopyStream(tuple(row) + (row_hash(row),) for row in rows)
+
+    cursor.execute('CREATE TEMPORARY TABLE "{}" AS SELECT {} FROM public."{}" WITH NO DATA'.format(
+        temp_table_name, quoted_columns, table_name))
+    cursor.copy_expert('COPY "{}" ({}) FROM STDIN'.format(temp_table_name, quoted_columns), stream)
+
+    # xmax is 0 only for the rows the INSERT created
+    cursor.execute('''
+        WITH upserted AS (
+            INSERT INTO public."{table_name}" AS t ({columns}) SELECT {columns} FROM "{temp_table_name}"
+            ON CONFLICT ("{pk}") DO UPDATE SET {updates}
+            WHERE t."{hash_column}" IS DISTINCT FROM EXCLUDED."{hash_column}"
+            RETURNING (xmax = 0) AS inserted
+        )
+        SELECT COUNT(*) FILTER (WHERE inserted), COUNT(*) FILTER (WHERE NOT inserted) FROM upserted
+    '''.format(
+        table_name=table_name, columns=quoted_columns, temp_table_name=temp_table_name, pk=columns[0],
+        updates=', '.join('"{0}" = EXCLUDED."{0}"'.format(column) for column in all_columns[1:]),
+        hash_column=hash_column))
+    inserted, updated = cursor.fetchone()
+    cursor.execute('DROP TABLE "{}"'.format(temp_table_name))
+
+    unchanged = stream.row_count - inserted - updated
+
+    elapsed = time.perf_counter() - start_time
+    print('Upserted %d rows into %s in %.1fs (%d inserted, %d updated, %d unchanged)' % (
+        stream.row_count, table_name, elapsed, inserted, updated, unchanged))
+
+    return inserted, updated, unchanged
+
 def rename_model_table(model, table_name):
     model._meta.db_table = table_name
 
@@ -43,3 +235,442 @@ def rename_model_table(model, table_name):
             del field.cached_col
         except AttributeError:
             pass
+
+def shadow_table_name(table_name):
+    return '%s__shadow' % (table_name,)
+
+def shadow_object_name(name):
+    # Index and constraint names are limited to 63 characters, long names get
+    # a hash so that names sharing a prefix (e.g. *_like indexes) stay unique
+    if len(name) > 56:
+        name = '%s_%s' % (name[:47], hashlib.md5(name.encode()).hexdigest()[:8])
+
+    return '%s_shadow' % (name,)
+
+def create_shadow_table(cursor, table_name):
+    """
+    Creates an empty UNLOGGED copy of table_name. Only primary keys and unique
+    constraints are created upfront (ON CONFLICT clauses rely on them); plain
+    indexes and foreign keys are left for swap_shadow_tables.
+    """
+    shadow_name = shadow_table_name(table_name)
+
+    cursor.execute('DROP TABLE IF EXISTS public."%s"' % (shadow_name,))
+    cursor.execute('CREATE UNLOGGED TABLE public."{}" (LIKE public."{}" INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'.format(
+        shadow_name, table_name))
+
+    cursor.execute('''
+        SELECT conname, pg_get_constraintdef(oid)
+        FROM pg_constraint
+        WHERE conrelid = %s::regclass AND contype IN ('p', 'u')
+    ''', ['public."%s"' % (table_name,)])
+
+    for name, definition in cursor.fetchall():
+        cursor.execute('ALTER TABLE public."{}" ADD CONSTRAINT "{}" {}'.format(
+            shadow_name, shadow_object_name(name), definition))
+
+def swap_shadow_tables(cursor, table_names):
+    """
+    Makes the loaded shadow copies of table_names durable, builds their
+    indexes and analyzes them, and then replaces the live tables by renaming.
+    Only the renaming locks the live tables (and the ones referencing them),
+    but those locks are held until the caller's transaction commits, so the
+    swap must be the last thing the caller does: work on the loaded rows
+    belongs before it, against the shadow tables.
+
+    Foreign keys (including the ones in other tables pointing to the swapped
+    tables) are recreated as NOT VALID: loaders have always run with triggers
+    disabled, so existing rows were never guaranteed to satisfy them. They
+    are validated once the caller commits (see validate_foreign_keys).
+    """
+    swapped_oids = []
+    renames = []
+    foreign_keys = []
+    sequences = []
+
+    for table_name in table_names:
+        shadow_name = shadow_table_name(table_name)
+        qualified_name = 'public."%s"' % (table_name,)
+
+        cursor.execute('SELECT %s::regclass::oid', [qualified_name])
+        swapped_oids.append(cursor.fetchone()[0])
+
+        cursor.execute('ALTER TABLE public."%s" SET LOGGED' % (shadow_name,))
+
+        # Primary keys and unique constraints already exist in the shadow
+        # table, foreign keys are added once every table has its final name
+        cursor.execute('''
+            SELECT conname, contype, pg_get_constraintdef(oid)
+            FROM pg_constraint
+            WHERE conrelid = %s::regclass AND contype IN ('p', 'u', 'f')
+        ''', [qualified_name])
+
+        for name, constraint_type, definition in cursor.fetchall():
+            if constraint_type == 'f':
+                foreign_keys.append(('public."%s"' % (table_name,), name, definition))
+            else:
+                renames.append('ALTER TABLE public."{}" RENAME CONSTRAINT "{}" TO "{}"'.format(
+                    table_name, shadow_object_name(name), name))
+
+        # Plain indexes (the ones not backing a constraint)
+        cursor.execute('''
+            SELECT index_class.relname, pg_index.indisunique, pg_get_indexdef(pg_index.indexrelid)
+            FROM pg_index
+            JOIN pg_class index_class ON index_class.oid = pg_index.indexrelid
+            WHERE pg_index.indrelid = %s::regclass
+              AND NOT EXISTS (
+                SELECT 1 FROM pg_constraint
+                WHERE pg_constraint.conindid = pg_index.indexrelid
+                  AND pg_constraint.conrelid = pg_index.indrelid)
+        ''', [qualified_name])
+
+        for name, is_unique, definition in cursor.fetchall():
+            # definition looks like: CREATE INDEX name ON public.table USING btree (column)
+            method_and_columns = definition[definition.index(' USING '):]
+            cursor.execute('CREATE {}INDEX "{}" ON public."{}"{}'.format(
+                'UNIQUE ' if is_unique else '', shadow_object_name(name), shadow_name, method_and_columns))
+            renames.append('ALTER INDEX public."{}" RENAME TO "{}"'.format(shadow_object_name(name), name))
+
+        # Serial sequences are owned by the live table and would be dropped along with it
+        cursor.execute('''
+            SELECT attname, pg_get_serial_sequence(%s, attname)
+            FROM pg_attribute
+            WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped
+        ''', [qualified_name, qualified_name])
+
+        for column, sequence in cursor.fetchall():
+            if sequence:
+                sequences.append('ALTER SEQUENCE {} OWNED BY public."{}"."{}"'.format(sequence, shadow_name, column))
+
+        cursor.execute('ANALYZE public."%s"' % (shadow_name,))
+
+    # Foreign keys from other tables pointing to the swapped ones
+    cursor.execute('''
+        SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid)
+        FROM pg_constraint
+        WHERE contype = 'f' AND confrelid = ANY(%s) AND NOT conrelid = ANY(%s)
+    ''', [swapped_oids, swapped_oids])
+    referencing_foreign_keys = cursor.fetchall()
+
+    with transaction.atomic():
+        for table_name, name, _ in referencing_foreign_keys:
+            cursor.execute('ALTER TABLE {} DROP CONSTRAINT "{}"'.format(table_name, name))
+
+        for statement in sequences:
+            cursor.execute(statement)
+
+        cursor.execute('DROP TABLE {}'.format(', '.join('public."%s"' % (table_name,) for table_name in table_names)))
+
+        for table_name in table_names:
+            cursor.execute('ALTER TABLE public."{}" RENAME TO "{}"'.format(shadow_table_name(table_name), table_name))
+
+        for statement in renames:
+            cursor.execute(statement)
+
+        for table_name, name, definition in foreign_keys + referencing_foreign_keys:
+            cursor.execute('ALTER TABLE {} ADD CONSTRAINT "{}" {} NOT VALID'.format(table_name, name, definition))
+
+    transaction.on_commit(functools.partial(validate_foreign_keys,
+        [(table_name, name) for table_name, name, _ in foreign_keys + referencing_foreign_keys]))
+
+    print('Swapped in %s' % (', '.join(table_names),))
+
+@contextlib.contextmanager
+def replace_tables(cursor, models_list):
+    """
+    Context manager for loaders that rebuild tables from scratch. It yields a
+    {model: table_name} dict with the tables the block has to write into
+    (with raw SQL, or through the ORM using model_table).
+
+    By default these are the live tables, emptied upfront with DELETE and with
+    triggers disabled until the block ends. With
+    settings.DATALOADER_SHADOW_TABLES they are empty UNLOGGED copies instead,
+    swapped in at the end (see swap_shadow_tables), so readers keep seeing
+    the previous data while the block runs. The block should then be the last
+    thing the caller's transaction does.
+    """
+    table_names = [model._meta.db_table for model in models_list]
+
+    if not settings.DATALOADER_SHADOW_TABLES:
+        with live_tables(cursor, models_list) as target_tables:
+            for table_name in table_names:
+                cursor.execute('DELETE FROM public."%s"' % (table_name,))
+
+            yield target_tables
+    else:
+        for table_name in table_names:
+            create_shadow_table(cursor, table_name)
+
+        yield {model: shadow_table_name(table_name) for model, table_name in zip(models_list, table_names)}
+
+        swap_shadow_tables(cursor, table_names)
+
+@contextlib.contextmanager
+def live_tables(cursor, models_list):
+    """
+    Counterpart of replace_tables for loaders that update tables in place:
+    yields the {model: table_name} dict of the live tables, with triggers
+    disabled until the block ends.
+    """
+    table_names = [model._meta.db_table for model in models_list]
+
+    for table_name in table_names:
+        cursor.execute('ALTER TABLE public."%s" DISABLE TRIGGER ALL;' % (table_name,))
+
+    yield dict(zip(models_list, table_names))
+
+    for table_name in table_names:
+        cursor.execute('ALTER TABLE public."%s" ENABLE TRIGGER ALL;' % (table_name,))
+
+@contextlib.contextmanager
+def model_table(model, table_name):
+    """
+    Temporarily points model to table_name, so that ORM queries made inside
+    the block use it.
+    """
+    original_table_name = model._meta.db_table
+    rename_model_table(model, table_name)
+
+    try:
+        yield
+    finally:
+        rename_model_table(model, original_table_name)
+
+# A table (or view) of an external database replicated into the table of
+# model. columns is a list of (source column, target column) pairs, by default
+# every column of model except the local_id primary keys that only exist here.
+# With ignore_conflicts, source rows repeating a primary key are skipped.
+ReplicatedTable = collections.namedtuple('ReplicatedTable', ['model', 'source', 'columns', 'ignore_conflicts'], defaults=[None, None, False])
+
+def replicated_columns(replicated_table):
+    if replicated_table.columns:
+        return replicated_table.columns
+
+    return [(field.column, field.column) for field in replicated_table.model._meta.concrete_fields if field.name != 'local_id']
+
+def fetch_source_rows(cursor, batch_size=None):
+    """
+    Yields the rows of the query executed on cursor, fetched DATALOADER_BATCH_SIZE
+    at a time.
+    """
+    batch_size = batch_size or settings.DATALOADER_BATCH_SIZE
+
+    while True:
+        rows = cursor.fetchmany(batch_size)
+
+        if not rows:
+            break
+
+        yield from rows
+
+def replicate_table(cursor, database, replicated_table, table_name, where=None, params=None, update_columns=None, conflict_columns=None):
+    """
+    Copies replicated_table from database into table_name. Rows are streamed
+    from the source cursor with fetchmany straight into COPY, so memory usage
+    is bound by the batch size, and no model instances are built: values only
+    go through the get_prep_value of their target field.
+
+    where (an SQL condition on the source, with params) restricts the rows
+    copied. With update_columns, rows whose primary key (or conflict_columns)
+    already exists in table_name get those columns updated instead.
+
+    Returns the number of rows read from the source.
+    """
+    model = replicated_table.model
+    columns = replicated_columns(replicated_table)
+    fields = {field.column: field for field in model._meta.concrete_fields}
+    prep_values = [fields[target_column].get_prep_value for _, target_column in columns]
+
+    source = replicated_table.source or '"%s"' % (model._meta.db_table,)
+    if not conflict_columns and (replicated_table.ignore_conflicts or update_columns):
+        conflict_columns = [model._meta.pk.column]
+
+    with connections[database].cursor() as source_cursor:
+        source_cursor.execute('SELECT {} FROM {}{}'.format(
+            ', '.join('"%s"' % (source_column,) for source_column, _ in columns), source,
+            ' WHERE %s' % (where,) if where else ''), params)
+
+        rows = (
+            tuple(prep_value(value) for prep_value, value in zip(prep_values, row))
+            for row in fetch_source_rows(source_cursor)
+        )
+        row_count = copy_rows(cursor, table_name, [target_column for _, target_column in columns], rows,
+            conflict_columns=conflict_columns, update_columns=update_columns)
+
+    print('Loaded %s' % (model._meta.db_table,))
+
+    return row_count
+
+def local_watermark(cursor, table_name, column):
+    """
+    Highest value of column in table_name (None when it's empty).
+    """
+    cursor.execute('SELECT MAX("{}") FROM public."{}"'.format(column, table_name))
+    return cursor.fetchone()[0]
+
+def local_count(cursor, table_name, where, params=None):
+    """
+    Number of rows of table_name matching where (an SQL condition, with params).
+    """
+    cursor.execute('SELECT COUNT(*) FROM public."{}" WHERE {}'.format(table_name, where), params)
+    return cursor.fetchone()[0]
+
+def full_sync_due(source):
+    """
+    Whether an incremental loader should reload source from scratch: it was
+    never fully loaded, or not in the last DATALOADER_FULL_SYNC_DAYS days.
+    """
+    since = datetime.datetime.now() - datetime.timedelta(days=settings.DATALOADER_FULL_SYNC_DAYS)
+    return not get_model('DataloaderSync').objects.filter(source=source, full_sync_at__gte=since).exists()
+
+def record_full_sync(source):
+    get_model('DataloaderSync').objects.update_or_create(source=source, defaults={'full_sync_at': datetime.datetime.now()})
+
+@contextlib.contextmanager
+def replicate_tables(cursor, database, replicated_tables):
+    """
+    Replaces the tables of replicated_tables (see replace_tables) with their
+    contents in database, then yields the {model: table_name} dict of the
+    tables written, so that the block can inspect them before they are
+    swapped in.
+    """
+    with replace_tables(cursor, [replicated_table.model for replicated_table in replicated_tables]) as target_tables:
+        for replicated_table in replicated_tables:
+            replicate_table(cursor, database, replicated_table, target_tables[replicated_table.model])
+
+        yield target_tables
+
+def replicate_staging_table(database, replicated_table):
+    """
+    Copies replicated_table from database into a new shadow table (see
+    create_shadow_table), committed on a connection of its own, so that it
+    can run on a separate thread or process.
+    """
+    table_name = replicated_table.model._meta.db_table
+
+    try:
+        with transaction.atomic(), connections['default'].cursor() as cursor:
+            create_shadow_table(cursor, table_name)
+            replicate_table(cursor, database, replicated_table, shadow_table_name(table_name))
+    finally:
+        # Connections are per thread and would be left open otherwise
+        connections.close_all()
+
+def remove_dangling_references(cursor, target_tables):
+    """
+    Restores the foreign keys between the tables of target_tables (a {model:
+    table_name} dict): references to rows missing from the referenced table
+    are set to NULL, or the referencing rows are deleted when the column is
+    not nullable.
+    """
+    for model, table_name in target_tables.items():
+        for field in model._meta.concrete_fields:
+            if not field.is_relation or field.related_model not in target_tables:
+                continue
+
+            referenced_table = target_tables[field.related_model]
+            condition = 't."{column}" IS NOT NULL AND NOT EXISTS (SELECT 1 FROM public."{referenced_table}" r WHERE r."{target_column}" = t."{column}")'.format(
+                column=field.column, referenced_table=referenced_table, target_column=field.target_field.column)
+
+            if field.null:
+                cursor.execute('UPDATE public."{}" t SET "{}" = NULL WHERE {}'.format(table_name, field.column, condition))
+            else:
+                cursor.execute('DELETE FROM public."{}" t WHERE {}'.format(table_name, condition))
+
+            if cursor.rowcount:
+                print('%s %d rows of %s referencing missing %s' % (
+                    'Nulled' if field.null else 'Deleted', cursor.rowcount, table_name, referenced_table))
+
+def validate_foreign_keys(foreign_keys):
+    """
+    Validates the given (table_name, constraint_name) NOT VALID foreign keys,
+    each in its own transaction. Unlike the swap, validating doesn't block
+    readers nor writers of the tables. Foreign keys that existing rows
+    violate are left NOT VALID.
+    """
+    with connections['default'].cursor() as cursor:
+        for table_name, name in foreign_keys:
+            try:
+                with transaction.atomic():
+                    cursor.execute('ALTER TABLE {} VALIDATE CONSTRAINT "{}"'.format(table_name, name))
+            except IntegrityError as e:
+                print('Left foreign key %s of %s NOT VALID: %s' % (name, table_name, e))
+
+@contextlib.contextmanager
+def replicate_tables_parallel(cursor, database, replicated_tables):
+    """
+    Counterpart of replicate_tables that copies the tables concurrently, each
+    one on its own source and target connection (up to
+    DATALOADER_REPLICATION_WORKERS processes at once), into shadow tables. References
+    between them are then made consistent (see remove_dangling_references)
+    and the {model: table_name} dict of the shadow tables is yielded. At the
+    end they are swapped in (see swap_shadow_tables).
+
+    Shadow tables are always used, whatever DATALOADER_SHADOW_TABLES says.
+    """
+    workers = max(settings.DATALOADER_REPLICATION_WORKERS, 1)
+
+    # Copying is CPU bound (values are converted in Python), so it runs on
+    # processes, spawned rather than forked so that they don't share the
+    # database connections of this one. Daemonic processes (like celery's
+    # prefork workers) can't have children, so threads are used there instead
+    if multiprocessing.current_process().daemon:
+        executor = ThreadPoolExecutor(workers)
+    else:
+        executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'), initializer=django.setup)
+
+    with executor:
+        futures = [executor.submit(replicate_staging_table, database, replicated_table) for replicated_table in replicated_tables]
+
+        for future in futures:
+            future.result()
+
+    table_names = [replicated_table.model._meta.db_table for replicated_table in replicated_tables]
+    target_tables = {
+        replicated_table.model: shadow_table_name(table_name)
+        for replicated_table, table_name in zip(replicated_tables, table_names)
+    }
+
+    remove_dangling_references(cursor, target_tables)
+
+    yield target_tables
+
+    swap_shadow_tables(cursor, table_names)
+
+def mark_dirty_dates(targets, dates):
+    """
+    Records dates touched by a loader so that the preprocessor recomputes
+    them on its next incremental run. targets are PreprocessDirtyDate.Targets
+    values ('proposicoes', 'noticias', 'daily_summary').
+    """
+    get_model('PreprocessDirtyDate').objects.bulk_create([
+        get_model('PreprocessDirtyDate')(target=target, date=date)
+        for target in targets
+        for date in set(dates)
+    ], ignore_conflicts=True)
+
+def date_fingerprints(cursor, table_name, date_column, columns, where=None, params=None):
+    """
+    Returns a {date: md5} dict summarizing the given columns of every row of
+    table_name, grouped by the day in date_column. Comparing the result taken
+    before and after a full reload tells which dates actually changed.
+
+    where (an SQL condition, with params) restricts the rows summarized, for
+    loaders that only touch some rows.
+    """
+    row_expression = "concat_ws(':', {})".format(', '.join('"%s"' % (c,) for c in columns))
+    cursor.execute('''
+        SELECT "{date_column}"::date, md5(string_agg({row}, ',' ORDER BY {row}))
+        FROM public."{table_name}"
+        WHERE "{date_column}" IS NOT NULL{where}
+        GROUP BY 1
+    '''.format(date_column=date_column, row=row_expression, table_name=table_name,
+        where=' AND (%s)' % (where,) if where else ''), params)
+
+    return dict(cursor.fetchall())
+
+def changed_dates(before, after):
+    """
+    Dates whose fingerprint differs between two date_fingerprints() results.
+    """
+    return {date for date in before.keys() | after.keys() if before.get(date) != after.get(date)}
@@ -1,41 +1,314 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import collections
+import contextlib
 import datetime
+import django
+import hashlib
+import itertools
+import json
+import ijson
+import multiprocessing
+import os
+import pickle
 import requests
 import re
+import tempfile
 
+from django.conf import settings
 from django.db import connections, transaction, IntegrityError
 
 import tenacity
 
 from .common import *
 
+PROPOSICAO_COLUMNS = [
+    'id', 'nome_processado', 'sigla_tipo', 'numero', 'ano', 'ementa',
+    'ementa_detalhada', 'keywords', 'data_apresentacao', 'orgao_numerador_id',
+    'uri_prop_anterior', 'uri_prop_principal', 'uri_prop_posterior',
+    'url_inteiro_teor', 'ultimo_status_situacao_descricao', 'ultimo_status_data',
+    'ultimo_status_relator_id', 'ultimo_status_orgao_id',
+]
+
+def dados_abertos_url(path):
+    return settings.DADOS_ABERTOS_URL.rstrip('/') + path
+
+# Number of parsed rows pickled together in a spool file
+SPOOL_CHUNK_SIZE = 10000
+
+YearlyFile = collections.namedtuple('YearlyFile', ['year', 'url', 'checksum', 'rows'])
+
+class SpooledRows:
+    """
+    Rows spooled to a file by spool_rows, read back one chunk at a time each
+    time they are iterated. len() is the number of rows.
+    """
+
+    def __init__(self, path, row_count):
+        self.path = path
+        self.row_count = row_count
+
+    def __iter__(self):
+        with open(self.path, 'rb') as f:
+            while True:
+                try:
+                    chunk = pickle.load(f)
+                except EOFError:
+                    return
+
+                yield from chunk
+
+    def __len__(self):
+        return self.row_count
+
+    def close(self):
+        os.remove(self.path)
+
+def spool_rows(parse, path, spool_path):
+    """
+    Writes the rows yielded by parse(path) to spool_path, in pickled chunks of
+    SPOOL_CHUNK_SIZE, and returns them as SpooledRows. Only a chunk is ever
+    held in memory, and only the SpooledRows go back from the parse workers.
+    """
+    rows = iter(parse(path))
+    row_count = 0
+
+    with open(spool_path, 'wb') as f:
+        while True:
+            chunk = list(itertools.islice(rows, SPOOL_CHUNK_SIZE))
+            if not chunk:
+                break
+
+            pickle.dump(chunk, f, protocol=pickle.HIGHEST_PROTOCOL)
+            row_count += len(chunk)
+
+    return SpooledRows(spool_path, row_count)
+
+def cache_file_paths(cache_dir, url):
+    key = hashlib.sha1(url.encode()).hexdigest()
+
+    return os.path.join(cache_dir, key + '.json'), os.path.join(cache_dir, key + '.meta.json')
+
+def download_yearly_file(url, cache_dir, loaded_checksum=None):
+    """
+    Downloads a yearly file into cache_dir and returns a (checksum, path)
+    tuple, or None when it doesn't exist. path is None when checksum equals
+    loaded_checksum, i.e. when the file didn't change since it was last
+    loaded.
+
+    Files are kept along with their ETag and Last-Modified headers and
+    revalidated with a conditional GET, so unchanged files are not downloaded
+    again. The response is streamed to disk, never held in memory.
+    """
+    content_path, meta_path = cache_file_paths(cache_dir, url)
+
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if not os.path.exists(content_path):
+            meta = {}
+    except (OSError, ValueError):
+        meta = {}
+
+    headers = {}
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+
+    with requests.get(url, headers=headers, stream=True) as r:
+        if r.status_code == 404:
+            return None
+
+        if r.status_code == 304:
+            checksum = meta['checksum']
+        else:
+            r.raise_for_status()
+
+            # Written aside and renamed, so that a cache file is never left half written
+            sha256 = hashlib.sha256()
+            with open(content_path + '.tmp', 'wb') as f:
+                for chunk in r.iter_content(chunk_size=1024*1024):
+                    sha256.update(chunk)
+                    f.write(chunk)
+            os.replace(content_path + '.tmp', content_path)
+
+            checksum = sha256.hexdigest()
+
+            with open(meta_path + '.tmp', 'w') as f:
+                json.dump({
+                    'url': url,
+                    'etag': r.headers.get('ETag'),
+                    'last_modified': r.headers.get('Last-Modified'),
+                    'checksum': checksum,
+                }, f)
+            os.replace(meta_path + '.tmp', meta_path)
+
+    return checksum, (None if checksum == loaded_checksum else content_path)
+
+def fetch_yearly_files(urls, parse, loaded_checksums):
+    """
+    Yields a YearlyFile for each of the urls ({year: url}), in year order,
+    with the rows yielded by parse(path) as SpooledRows (see spool_rows),
+    removed once the caller moves on. checksum is None for missing files, and
+    rows is None for files whose checksum is the one given in
+    loaded_checksums ({url: checksum}), which are not parsed at all.
+
+    Files are downloaded concurrently on DATALOADER_DOWNLOAD_WORKERS threads
+    and decoded on DATALOADER_PARSE_WORKERS processes, while the caller (the
+    single database writer) consumes the previous years. At most twice as
+    many years as download workers are in flight, which bounds memory use.
+
+    Files are kept in DADOS_ABERTOS_CACHE_DIR (see download_yearly_file), or
+    in a temporary directory removed at the end when it is empty.
+    """
+    download_workers = max(settings.DATALOADER_DOWNLOAD_WORKERS, 1)
+    parse_workers = settings.DATALOADER_PARSE_WORKERS
+
+    # Daemonic processes (like celery's prefork workers) can't have children,
+    # so parse on the download threads instead
+    if multiprocessing.current_process().daemon:
+        parse_workers = 0
+
+    years = iter(sorted(urls))
+    pending = collections.deque()
+
+    with contextlib.ExitStack() as stack:
+        cache_dir = settings.DADOS_ABERTOS_CACHE_DIR
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        else:
+            cache_dir = stack.enter_context(tempfile.TemporaryDirectory())
+
+        spool_dir = stack.enter_context(tempfile.TemporaryDirectory())
+
+        # Workers are spawned rather than forked, since the pool starts them
+        # lazily from the download threads and forking a threaded process can
+        # deadlock
+        parse_pool = stack.enter_context(ProcessPoolExecutor(parse_workers,
+            mp_context=multiprocessing.get_context('spawn'), initializer=django.setup)) if parse_workers > 0 else None
+        download_pool = stack.enter_context(ThreadPoolExecutor(download_workers))
+
+        def fetch(year):
+            url = urls[year]
+            downloaded = download_yearly_file(url, cache_dir, loaded_checksums.get(url))
+
+            if downloaded is None:
+                return YearlyFile(year, url, None, None)
+
+            checksum, path = downloaded
+            spool_path = os.path.join(spool_dir, '%d.pickle' % (year,))
+
+            if path is None:
+                return YearlyFile(year, url, checksum, None)
+            if parse_pool:
+                return YearlyFile(year, url, checksum, parse_pool.submit(spool_rows, parse, path, spool_path).result())
+            return YearlyFile(year, url, checksum, spool_rows(parse, path, spool_path))
+
+        try:
+            for year in itertools.islice(years, download_workers * 2):
+                pending.append(download_pool.submit(fetch, year))
+
+            while pending:
+                future = pending.popleft()
+
+                for next_year in itertools.islice(years, 1):
+                    pending.append(download_pool.submit(fetch, next_year))
+
+                yearly_file = future.result()
+                yield yearly_file
+
+                if yearly_file.rows is not None:
+                    yearly_file.rows.close()
+        finally:
+            for future in pending:
+                future.cancel()
+
+def sync_yearly_files(cursor, name, models_list, path, parse, write_year, delete_year, finish=None):
+    """
+    Loads the yearly files from 2001 to the current year (path is formatted
+    with the year) into the tables of models_list. write_year(target_tables,
+    year, rows) writes the rows of a file, target_tables being the
+    {model: table_name} dict from replace_tables. rows are SpooledRows, which
+    can be iterated more than once but should not be built in memory.
+
+    Loaded files are recorded in DadosAbertosArquivo. Once every year is
+    there, later runs only parse and write the files whose checksum changed,
+    after delete_year(target_tables, year, rows) removes the rows the
+    previous version left in the live tables. Otherwise the tables are
+    rebuilt from scratch.
+
+    finish(target_tables), when given, runs once every file is written. Work
+    on the loaded rows belongs there rather than after this returns: rebuilt
+    tables are swapped in at the end, which locks the live ones until the
+    transaction commits.
+    """
+    manifest_model = get_model('DadosAbertosArquivo')
+
+    urls = {year: dados_abertos_url(path % (year,)) for year in range(2001, datetime.datetime.now().year+1)}
+    manifest = {m.url: m for m in manifest_model.objects.filter(url__in=urls.values())}
+
+    if manifest and models_list[0].objects.exists():
+        tables_context = live_tables(cursor, models_list)
+    else:
+        manifest_model.objects.filter(url__in=urls.values()).delete()
+        manifest = {}
+        tables_context = replace_tables(cursor, models_list)
+
+    loaded_checksums = {url: m.checksum for url, m in manifest.items()}
+
+    with tables_context as target_tables:
+        for yearly_file in fetch_yearly_files(urls, parse, loaded_checksums):
+            year, url = yearly_file.year, yearly_file.url
+
+            if yearly_file.checksum is None:
+                if url in manifest:
+                    delete_year(target_tables, year, [])
+                    manifest[url].delete()
+
+                print("Missing %s %d" % (name, year))
+                continue
+
+            if yearly_file.rows is None:
+                print("Unchanged %s %d" % (name, year))
+                continue
+
+            if url in manifest:
+                delete_year(target_tables, year, yearly_file.rows)
+
+            write_year(target_tables, year, yearly_file.rows)
+
+            manifest_model.objects.update_or_create(url=url, defaults={
+                'year': year,
+                'checksum': yearly_file.checksum,
+                'row_count': len(yearly_file.rows),
+            })
+
+            print("Loaded %s %d" % (name, year))
+
+        if finish:
+            finish(target_tables)
+
 @tenacity.retry(**TENACITY_ARGUMENTS)
 @transaction.atomic
 def load_deputados():
     with connections['default'].cursor() as cursor:  
-        url = 'https://dadosabertos.camara.leg.br/arquivos/deputados/json/deputados.json'
+        url = dados_abertos_url('/arquivos/deputados/json/deputados.json')
 
         r = requests.get(url)
         j = r.json()
 
-        count = len(j['dados'])
-        field_values = []
-        for row in j['dados']:
-            id = int(re.search('/([0-9]*)$', row['uri']).group(1))
-            nome = row['nome']
-            # TODO: Puxar partido e UF para incorporar aqui.
-            nome_processado = '{} (Partido/UF)'.format(nome)
-
-            field_values.append(id)
-            field_values.append(nome)
-            field_values.append(nome_processado)
-        
-        
-        cursor.execute('ALTER TABLE app_deputado DISABLE TRIGGER ALL;')
-        cursor.execute('DELETE FROM app_deputado')
-        sql = 'INSERT INTO app_deputado (id, nome, nome_processado) VALUES %s' % \
-            ', '.join('(%s, %s, %s)' for i in range(count))
-        cursor.execute(sql, field_values)
-        cursor.execute('ALTER TABLE app_deputado ENABLE TRIGGER ALL;')
+        def get_rows():
+            for row in j['dados']:
+                id = int(re.search('/([0-9]*)$', row['uri']).group(1))
+                nome = row['nome']
+                # TODO: Puxar partido e UF para incorporar aqui.
+                nome_processado = '{} (Partido/UF)'.format(nome)
+
+                yield (id, nome, nome_processado)
+
+        with replace_tables(cursor, [get_model('Deputado')]) as target_tables:
+            copy_rows(cursor, target_tables[get_model('Deputado')], ['id', 'nome', 'nome_processado'], get_rows())
 
         print("Loaded deputados")
 
@@ -43,20 +316,16 @@ def load_deputados():
 @transaction.atomic
 def load_orgaos():
     with connections['default'].cursor() as cursor:  
-        url = 'https://dadosabertos.camara.leg.br/api/v2/orgaos?ordem=ASC&ordenarPor=id'
+        url = dados_abertos_url('/api/v2/orgaos?ordem=ASC&ordenarPor=id')
 
-        count = 0
-        field_values = []
+        rows = []
         
         while (True):
             r = requests.get(url, headers={ 'accept': 'application/json' })
             j = r.json()
 
             for row in j['dados']:
-                count += 1
-                field_values.append(row['id'])
-                field_values.append(row['sigla'])
-                field_values.append(row['nome'])
+                rows.append((row['id'], row['sigla'], row['nome']))
             
             # Get URL of next page or break out of while
             is_next_link = [l['rel']=='next' for l in j['links']]
@@ -66,103 +335,240 @@ def load_orgaos():
             else:
                 break
 
-        cursor.execute('ALTER TABLE app_orgao DISABLE TRIGGER ALL;')
-        cursor.execute('DELETE FROM app_orgao')
-        sql = 'INSERT INTO app_orgao (id, sigla, nome) VALUES %s' % \
-            ', '.join('(%s, %s, %s)' for i in range(count))
-        cursor.execute(sql, field_values)
-        cursor.execute('ALTER TABLE app_orgao ENABLE TRIGGER ALL;')
+        with replace_tables(cursor, [get_model('Orgao')]) as target_tables:
+            copy_rows(cursor, target_tables[get_model('Orgao')], ['id', 'sigla', 'nome'], rows)
 
         print("Loaded orgaos")
 
-@tenacity.retry(**TENACITY_ARGUMENTS)
-@transaction.atomic
-def load_proposicoes():
-    with connections['default'].cursor() as cursor:  
-        cursor.execute('ALTER TABLE app_proposicao DISABLE TRIGGER ALL;')
-        cursor.execute('DELETE FROM app_proposicao')
+def parse_uri_id(uri):
+    try:
+        return int(re.search('/([0-9]*)$', uri).group(1))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+def parse_proposicoes(path):
+    """
+    Decodes a yearly proposicoes file into rows following PROPOSICAO_COLUMNS.
+    Entries of dados are parsed one at a time from the file, so memory use
+    doesn't depend on the size of the JSON: a first pass only collects the
+    names (for the EMP ones, named after their principal), and a second one
+    yields the rows. Runs on the parse workers, so it must not touch the
+    database.
+    """
+    nomes = {}         # {id: nome_processado}
+    numeros = {}       # {id: numero}
+    last_indexes = {}  # {id: index of its last entry}
+    emendas = []       # [(id, id_principal)]
+
+    with open(path, 'rb') as f:
+        for index, p in enumerate(ijson.items(f, 'dados.item')):
+            nomes[p['id']] = '{} {}/{}'.format(p['siglaTipo'], p['numero'], p['ano'])
+            numeros[p['id']] = p['numero']
+            last_indexes[p['id']] = index
+
+            if p['siglaTipo'] == 'EMP':
+                emendas.append((p['id'], parse_uri_id(p['uriPropPrincipal'])))
+
+    for id, id_principal in emendas:
+        if id_principal in nomes:
+            nomes[id] = 'EMP {} => {}'.format(numeros[id], nomes[id_principal])
+
+    with open(path, 'rb') as f:
+        for index, p in enumerate(ijson.items(f, 'dados.item')):
+            # Repeated ids keep their last values
+            if last_indexes[p['id']] != index:
+                continue
+
+            yield (
+                p['id'],
+                nomes[p['id']],
+                p['siglaTipo'],
+                p['numero'],
+                p['ano'],
+                p['ementa'],
+                p['ementaDetalhada'],
+                p['keywords'],
+                datetime.datetime.strptime(p['dataApresentacao'], "%Y-%m-%dT%H:%M:%S").date(),
+                parse_uri_id(p['uriOrgaoNumerador']),
+                p['uriPropAnterior'],
+                p['uriPropPrincipal'],
+                p['uriPropPosterior'],
+                p['urlInteiroTeor'],
+                p['ultimoStatus']['descricaoSituacao'],
+                datetime.datetime.strptime(p['ultimoStatus']['data'], "%Y-%m-%dT%H:%M:%S").date(),
+                parse_uri_id(p['ultimoStatus']['uriRelator']),
+                parse_uri_id(p['ultimoStatus']['uriOrgao']),
+            )
+
+def parse_proposicoes_autores(path):
+    """
+    Decodes a yearly proposicoes autores file into (proposicao_id,
+    deputado_id, orgao_id) tuples, ids being None when missing.
+    """
+    with open(path, 'rb') as f:
+        for row in ijson.items(f, 'dados.item'):
+            deputado_id = None
+            orgao_id = None
 
-        # Dict to store {tex_url_formulario_publicado => ide_formulario_publicado}
-        # tex_url_formulario_publicado: ID proposição
-        formulario_publicado_dict = {}
-        for r in get_model('EnqueteFormularioPublicado').objects.values_list('ide_formulario_publicado', 'tex_url_formulario_publicado'):
             try:
-                formulario_publicado_dict[int(r[1])] = r[0]
-            except ValueError:
+                deputado_id = int(re.search(r'/deputados/([0-9]+)', row['uriAutor']).group(1))
+            except AttributeError:
                 pass
 
-        for i in range(2001, datetime.datetime.now().year+1):
-            url = 'https://dadosabertos.camara.leg.br/arquivos/proposicoes/json/proposicoes-%s.json' % (i,)
-
-            r = requests.get(url)
-
-            if r.status_code == 404:
-                print("Missing proposicoes %d" % (i,))
-                continue
+            try:
+                orgao_id = int(re.search(r'/orgaos/([0-9]+)', row['uriAutor']).group(1))
+            except AttributeError:
+                pass
 
-            j = r.json()
-            
-            proposicoes = {}
+            yield (row.get('idProposicao'), deputado_id, orgao_id)
 
-            for p in j['dados']:
-                try:
-                    orgao_numerador_id = int(re.search('/([0-9]*)$', p['uriOrgaoNumerador']).group(1))
-                except AttributeError:
-                    orgao_numerador_id = None
+def parse_proposicoes_temas(path):
+    """
+    Decodes a yearly proposicoes temas file into (proposicao_id, tema_id,
+    tema_nome) tuples.
+    """
+    with open(path, 'rb') as f:
+        for row in ijson.items(f, 'dados.item'):
+            yield (parse_uri_id(row['uriProposicao']), row['codTema'], row['tema'])
 
-                try:
-                    ultimo_status_orgao_id = int(re.search('/([0-9]*)$', p['ultimoStatus']['uriOrgao']).group(1))
-                except AttributeError:
-                    ultimo_status_orgao_id = None
+def year_bounds(year):
+    return datetime.date(year, 1, 1), datetime.date(year+1, 1, 1)
 
-                try:
-                    ultimo_status_relator_id = int(re.search('/([0-9]*)$', p['ultimoStatus']['uriRelator']).group(1))
-                except AttributeError:
-                    ultimo_status_relator_id = None
-                
-                try:
-                    formulario_publicado_id = formulario_publicado_dict[p['id']]
-                except KeyError:
-                    formulario_publicado_id = None
-
-                nome_processado = '{} {}/{}'.format(p['siglaTipo'], p['numero'], p['ano'])
-
-                proposicao = get_model('Proposicao')(
-                    id = p['id'],
-                    nome_processado = nome_processado,
-                    sigla_tipo = p['siglaTipo'],
-                    numero = p['numero'],
-                    ano = p['ano'],
-                    ementa = p['ementa'],
-                    ementa_detalhada = p['ementaDetalhada'],
-                    keywords = p['keywords'],
-                    data_apresentacao = datetime.datetime.strptime(p['dataApresentacao'], "%Y-%m-%dT%H:%M:%S").date(),
-                    orgao_numerador_id = orgao_numerador_id,
-                    uri_prop_anterior = p['uriPropAnterior'],
-                    uri_prop_principal = p['uriPropPrincipal'],
-                    uri_prop_posterior = p['uriPropPosterior'],
-                    url_inteiro_teor = p['urlInteiroTeor'],
-                    formulario_publicado_id = formulario_publicado_id,
-                    ultimo_status_situacao_descricao = p['ultimoStatus']['descricaoSituacao'],
-                    ultimo_status_data = datetime.datetime.strptime(p['ultimoStatus']['data'], "%Y-%m-%dT%H:%M:%S").date(),
-                    ultimo_status_relator_id = ultimo_status_relator_id,
-                    ultimo_status_orgao_id = ultimo_status_orgao_id,
-                )
-                proposicoes[p['id']] = proposicao
-
-            for id, proposicao in proposicoes.items():
-                if proposicao.sigla_tipo == 'EMP':
-                    try:
-                        id_principal = int(re.search('/([0-9]*)$', proposicao.uri_prop_principal).group(1))
-                        proposicao.nome_processado = 'EMP {} => {}'.format(proposicao.numero, proposicoes[id_principal].nome_processado)
-                    except (AttributeError, KeyError):
-                        pass
-
-            get_model('Proposicao').objects.bulk_create(list(proposicoes.values()))
-
-            print("Loaded proposicoes %d" % (i,))
-
-        cursor.execute('ALTER TABLE app_proposicao ENABLE TRIGGER ALL;')
+@tenacity.retry(**TENACITY_ARGUMENTS)
+@transaction.atomic
+def load_proposicoes():
+    with connections['default'].cursor() as cursor:  
+        proposicao_model = get_model('Proposicao')
+        counts = collections.Counter()
+
+        def write_year(target_tables, year, rows):
+            # Only new and changed rows are written (see upsert_changed_rows)
+            inserted, updated, unchanged = upsert_changed_rows(cursor, target_tables[proposicao_model], PROPOSICAO_COLUMNS, rows)
+            counts.update(inserted=inserted, updated=updated, unchanged=unchanged)
+
+        def delete_year(target_tables, year, rows):
+            # Yearly files hold the proposicoes presented in that year, so
+            # the ones of that year missing from the new version were removed
+            cursor.execute('''
+                DELETE FROM public."{}"
+                WHERE data_apresentacao >= %s AND data_apresentacao < %s AND NOT id = ANY(%s)
+                RETURNING id
+            '''.format(target_tables[proposicao_model]), [*year_bounds(year), [row[0] for row in rows]])
+            deleted_ids = [id for id, in cursor.fetchall()]
+            counts.update(deleted=len(deleted_ids))
+
+            delete_proposicoes_references(cursor, deleted_ids)
+
+        def finish(target_tables):
+            print('Proposicoes: %d inserted, %d updated, %d unchanged, %d deleted' % (
+                counts['inserted'], counts['updated'], counts['unchanged'], counts['deleted']))
+
+            link_formularios_publicados(cursor, target_tables[proposicao_model])
+
+        sync_yearly_files(cursor, 'proposicoes', [proposicao_model],
+            '/arquivos/proposicoes/json/proposicoes-%s.json',
+            parse_proposicoes, write_year, delete_year, finish)
+
+def delete_proposicoes_references(cursor, proposicao_ids):
+    """
+    Deletes the rows referencing the given (deleted) proposicoes: their
+    aggregates, ficha pageviews, autores, temas and noticias links. Loaders
+    run with triggers disabled, so the database doesn't cascade, and the
+    incremental preprocess would never recompute their aggregates.
+    """
+    if not proposicao_ids:
+        return
+
+    proposicao_model = get_model('Proposicao')
+
+    for model in [
+        get_model('ProposicaoAggregated'),
+        get_model('ProposicaoFichaPageviews'),
+        proposicao_model.autor.through,
+        proposicao_model.tema.through,
+        get_model('Noticia').proposicoes.through,
+    ]:
+        cursor.execute('DELETE FROM public."{}" WHERE proposicao_id = ANY(%s)'.format(model._meta.db_table), [proposicao_ids])
+
+def link_formularios_publicados(cursor, table_name):
+    """
+    Points each proposicao to its enquete, the formulario publicado whose
+    tex_url_formulario_publicado is the proposicao id (the latest one when
+    there are several). Enquetes are published after the proposicoes they
+    are about, whose yearly files may not change anymore, so links are
+    refreshed on every load rather than when the files are parsed.
+
+    The dates with votes or comments of relinked enquetes are marked for the
+    proposicoes preprocess.
+    """
+    cursor.execute('''
+        CREATE TEMPORARY TABLE formulario_publicado_links AS
+        SELECT p.id, p.formulario_publicado_id AS old_id, l.formulario_publicado_id AS new_id
+        FROM public."{}" p
+        LEFT JOIN (
+            SELECT btrim(tex_url_formulario_publicado)::bigint AS proposicao_id, MAX(ide_formulario_publicado) AS formulario_publicado_id
+            FROM "Formulario_Publicado"
+            WHERE btrim(tex_url_formulario_publicado) ~ '^[0-9]{{1,18}}$'
+            GROUP BY 1
+        ) l ON l.proposicao_id = p.id
+        WHERE p.formulario_publicado_id IS DISTINCT FROM l.formulario_publicado_id
+    '''.format(table_name))
+
+    # Stale links are cleared first, so that an enquete moving to another
+    # proposicao never collides with itself on the unique constraint
+    cursor.execute('''
+        UPDATE public."{}" p SET formulario_publicado_id = NULL
+        FROM formulario_publicado_links l WHERE l.id = p.id AND l.old_id IS NOT NULL
+    '''.format(table_name))
+    cursor.execute('''
+        UPDATE public."{}" p SET formulario_publicado_id = l.new_id
+        FROM formulario_publicado_links l WHERE l.id = p.id AND l.new_id IS NOT NULL
+    '''.format(table_name))
+
+    cursor.execute('''
+        SELECT DISTINCT r.dat_resposta::date FROM "Resposta" r
+        JOIN formulario_publicado_links l ON r.ide_formulario_publicado IN (l.old_id, l.new_id)
+        WHERE r.dat_resposta IS NOT NULL
+        UNION
+        SELECT DISTINCT c.dat_posicionamento::date FROM "Posicionamento" c
+        JOIN formulario_publicado_links l ON c.ide_formulario_publicado IN (l.old_id, l.new_id)
+        WHERE c.dat_posicionamento IS NOT NULL
+    ''')
+    mark_dirty_dates(['proposicoes'], [date for date, in cursor.fetchall()])
+
+    cursor.execute('SELECT COUNT(*) FROM formulario_publicado_links')
+    print('Relinked %d proposicoes to their enquetes' % cursor.fetchone())
+
+    cursor.execute('DROP TABLE formulario_publicado_links')
+
+def sync_autores(cursor):
+    """
+    Creates the missing autor instances for deputados and orgaos and updates
+    the names of the existing ones. Autor ids are kept, so proposicao autor
+    rows of unchanged years stay valid.
+    """
+    for column, source_table, name_column in [('deputado_id', 'app_deputado', 'nome_processado'), ('orgao_id', 'app_orgao', 'nome')]:
+        cursor.execute('''
+            INSERT INTO app_autor ({column}, nome_processado)
+            SELECT s.id, s.{name_column} FROM {source_table} s
+            WHERE NOT EXISTS (SELECT 1 FROM app_autor a WHERE a.{column} = s.id)
+        '''.format(column=column, source_table=source_table, name_column=name_column))
+        cursor.execute('''
+            UPDATE app_autor a SET nome_processado = s.{name_column}
+            FROM {source_table} s
+            WHERE a.{column} = s.id AND a.nome_processado IS DISTINCT FROM s.{name_column}
+        '''.format(column=column, source_table=source_table, name_column=name_column))
+
+def delete_proposicoes_year(cursor, table_name, year, proposicao_ids):
+    """
+    Deletes the rows of a proposicao_id table (autores, temas) that belong to
+    the yearly file of year, given the proposicao ids of its new version.
+    """
+    cursor.execute('''
+        DELETE FROM public."{}"
+        WHERE proposicao_id = ANY(%s) OR proposicao_id IN (
+            SELECT id FROM app_proposicao WHERE data_apresentacao >= %s AND data_apresentacao < %s)
+    '''.format(table_name), [proposicao_ids, *year_bounds(year)])
 
 @tenacity.retry(**TENACITY_ARGUMENTS)
 @transaction.atomic
@@ -170,127 +576,57 @@ def load_proposicoes_autores():
     with connections['default'].cursor() as cursor:  
 
         # Create autor instance for all deputados and orgaos
-        get_model('Autor').objects.all().delete()
-        get_model('Autor').objects.bulk_create(
-            [ get_model('Autor')(deputado_id=d.id, nome_processado=d.nome_processado) for d in get_model('Deputado').objects.all() ]
-        )
-        get_model('Autor').objects.bulk_create(
-            [ get_model('Autor')(orgao_id=o.id, nome_processado=o.nome) for o in get_model('Orgao').objects.all() ]
-        )
+        sync_autores(cursor)
 
         deputados_autores = { d['id']: d['autor__id'] for d in get_model('Deputado').objects.values('id', 'autor__id') }
         orgaos_autores = { o['id']: o['autor__id'] for o in get_model('Orgao').objects.values('id', 'autor__id') }
 
-        cursor.execute('ALTER TABLE app_proposicao_autor DISABLE TRIGGER ALL;')
-        cursor.execute('DELETE FROM app_proposicao_autor')
+        proposicao_autor_model = get_model('Proposicao').autor.through
 
-        for i in range(2001, datetime.datetime.now().year+1):
-            url = 'https://dadosabertos.camara.leg.br/arquivos/proposicoesAutores/json/proposicoesAutores-%s.json' % (i,)
+        def write_year(target_tables, year, autores):
+            def get_rows():
+                for proposicao_id, deputado_id, orgao_id in autores:
+                    # An orgao takes precedence over a deputado
+                    autor_id = orgaos_autores.get(orgao_id) or deputados_autores.get(deputado_id)
 
-            r = requests.get(url)
+                    # TODO: Tratar quando o uriAutor não existir
+                    # (p. ex. sempre que o projeto for de autoria do Senado!!!)
 
-            if r.status_code == 404:
-                print("Missing proposicoes autores %d" % (i,))
-                continue
+                    if proposicao_id and autor_id:
+                        yield (proposicao_id, autor_id)
 
-            j = r.json()
+            copy_rows(cursor, target_tables[proposicao_autor_model], ['proposicao_id', 'autor_id'], get_rows(),
+                conflict_columns=['proposicao_id', 'autor_id'])
 
-            count = 0
-            field_values = []
-            for row in j['dados']:
-                deputado_id = None
-                orgao_id = None
-                autor_id = None
+        def delete_year(target_tables, year, autores):
+            delete_proposicoes_year(cursor, target_tables[proposicao_autor_model], year,
+                [proposicao_id for proposicao_id, _, _ in autores if proposicao_id])
 
-                try:
-                    deputado_id = int(re.search(r'/deputados/([0-9]+)', row['uriAutor']).group(1))
-                    if deputados_autores.get(deputado_id):
-                        autor_id = deputados_autores[deputado_id]
-                    else:
-                        deputado_id = None
-                except AttributeError:
-                    pass
-
-                try:
-                    orgao_id = int(re.search(r'/orgaos/([0-9]+)', row['uriAutor']).group(1))
-                    if orgaos_autores.get(orgao_id):
-                        autor_id = orgaos_autores[orgao_id]
-                    else:
-                        orgao_id = None
-                except AttributeError:
-                    pass
-
-                # TODO: Tratar quando o uriAutor não existir
-                # (p. ex. sempre que o projeto for de autoria do Senado!!!)
-
-                try:
-                    proposicao_id = row['idProposicao']
-                except KeyError:
-                    proposicao_id = None
-
-                if proposicao_id and autor_id:
-                    count += 1
-                    field_values.append(proposicao_id)
-                    field_values.append(autor_id)
-                            
-            sql = 'INSERT INTO app_proposicao_autor (proposicao_id, autor_id) VALUES {} ON CONFLICT DO NOTHING' \
-                .format(', '.join('(%s, %s)' for i in range(count)))
-            cursor.execute(sql, field_values)
-            
-            print("Loaded proposicoes autores %d" % (i,))
-    
-        cursor.execute('ALTER TABLE app_proposicao_autor ENABLE TRIGGER ALL;')
+        sync_yearly_files(cursor, 'proposicoes autores', [proposicao_autor_model],
+            '/arquivos/proposicoesAutores/json/proposicoesAutores-%s.json', parse_proposicoes_autores,
+            write_year, delete_year)
 
 
 @tenacity.retry(**TENACITY_ARGUMENTS)
 @transaction.atomic
 def load_proposicoes_temas():
     with connections['default'].cursor() as cursor:  
-        cursor.execute('ALTER TABLE app_proposicao_tema DISABLE TRIGGER ALL;')
-        cursor.execute('ALTER TABLE app_tema DISABLE TRIGGER ALL;')
-        cursor.execute('DELETE FROM app_proposicao_tema')
-        cursor.execute('DELETE FROM app_tema')
-
-        temas_id_set = set()
+        proposicao_tema_model = get_model('Proposicao').tema.through
 
-        for i in range(2001, datetime.datetime.now().year+1):
-            url = 'https://dadosabertos.camara.leg.br/arquivos/proposicoesTemas/json/proposicoesTemas-%s.json' % (i,)
+        def write_year(target_tables, year, temas):
+            # Temas are upserted and never deleted, since unchanged years may still use them
+            temas_nomes = { tema_id: tema_nome for _, tema_id, tema_nome in temas }
+            copy_rows(cursor, get_model('Tema')._meta.db_table, ['id', 'nome'], temas_nomes.items(),
+                conflict_columns=['id'], update_columns=['nome'])
 
-            r = requests.get(url)
+            rows = ((proposicao_id, tema_id) for proposicao_id, tema_id, _ in temas if proposicao_id and tema_id)
+            copy_rows(cursor, target_tables[proposicao_tema_model], ['proposicao_id', 'tema_id'], rows,
+                conflict_columns=['proposicao_id', 'tema_id'])
 
-            if r.status_code == 404:
-                print("Missing proposicoes temas %d" % (i,))
-                continue
-
-            j = r.json()
-
-            count = 0
-            field_values = []
-    
-            for row in j['dados']:
-                try:
-                    proposicao_id = re.search('/([0-9]*)$', row['uriProposicao']).group(1)
-                except get_model('Proposicao').DoesNotExist:
-                    proposicao_id = None
-                
-                tema_id = row['codTema']
-                if tema_id not in temas_id_set:
-                    tema = get_model('Tema').objects.create(
-                        id = row['codTema'],
-                        nome = row['tema']
-                    )
-                    temas_id_set.add(row['codTema'])
-
-                if proposicao_id and tema_id:
-                    count += 1
-                    field_values.append(proposicao_id)
-                    field_values.append(tema_id)
-
-            sql = 'INSERT INTO app_proposicao_tema (proposicao_id, tema_id) VALUES %s ON CONFLICT DO NOTHING' % \
-                ', '.join('(%s, %s)' for i in range(count))
-            cursor.execute(sql, field_values)
-            
-            print("Loaded proposicoes temas %d" % (i,))
+        def delete_year(target_tables, year, temas):
+            delete_proposicoes_year(cursor, target_tables[proposicao_tema_model], year,
+                [proposicao_id for proposicao_id, _, _ in temas if proposicao_id])
 
-        cursor.execute('ALTER TABLE app_proposicao_tema ENABLE TRIGGER ALL;')
-        cursor.execute('ALTER TABLE app_tema ENABLE TRIGGER ALL;')
+        sync_yearly_files(cursor, 'proposicoes temas', [proposicao_tema_model],
+            '/arquivos/proposicoesTemas/json/proposicoesTemas-%s.json', parse_proposicoes_temas,
+            write_year, delete_year)
@@ -1,43 +1,103 @@
 from django.conf import settings
 from django.db import connections, transaction, IntegrityError
 
+import datetime
 import tenacity
 
 from .common import *
 
 @tenacity.retry(**TENACITY_ARGUMENTS)
 @transaction.atomic
-def load_enquetes():
+def load_enquetes(full=None):
+    """
+    Loads the enquetes tables. Respostas, itens and posicionamentos are only
+    ever appended to, so by default only the rows past the highest id already
+    loaded are copied, along with the moderation fields (cod_autorizado,
+    qtd_curtidas, qtd_descurtidas) of the posicionamentos of the last
+    DATALOADER_ENQUETES_RESYNC_DAYS days. Every DATALOADER_FULL_SYNC_DAYS
+    days (or with full) the tables are reloaded from scratch instead, which
+    also catches deletions and older edits.
+    """
     if 'enquetes' not in settings.DATABASES:
         print('Enquetes connection not available')
         return
- 
+
+    if full is None:
+        full = full_sync_due('enquetes')
+
+    if full:
+        load_enquetes_full()
+        record_full_sync('enquetes')
+    else:
+        load_enquetes_incremental()
+
+def load_enquetes_full():
     with connections['default'].cursor() as cursor:
-        models_list = [
-            get_model('EnqueteFormularioPublicado'),
-            get_model('EnqueteResposta'),
-            get_model('EnqueteItemResposta'),
-            get_model('EnquetePosicionamento'),
+        replicated_tables = [
+            ReplicatedTable(get_model('EnqueteFormularioPublicado')),
+            ReplicatedTable(get_model('EnqueteResposta')),
+            ReplicatedTable(get_model('EnqueteItemResposta')),
+            ReplicatedTable(get_model('EnquetePosicionamento')),
+        ]
+
+        # (model, date_column, columns) that feed ProposicaoAggregated
+        fingerprint_args = [
+            (get_model('EnqueteResposta'), 'dat_resposta', ['ide_formulario_publicado']),
+            (get_model('EnquetePosicionamento'), 'dat_posicionamento', ['ide_formulario_publicado', 'cod_autorizado']),
         ]
+        fingerprints_before = [
+            date_fingerprints(cursor, model._meta.db_table, date_column, columns)
+            for model, date_column, columns in fingerprint_args
+        ]
+
+        with replicate_tables(cursor, 'enquetes', replicated_tables) as target_tables:
+            for (model, date_column, columns), before in zip(fingerprint_args, fingerprints_before):
+                after = date_fingerprints(cursor, target_tables[model], date_column, columns)
+                mark_dirty_dates(['proposicoes'], changed_dates(before, after))
+
+# Columns of posicionamentos that change after they are posted
+ENQUETE_POSICIONAMENTO_MODERATION_COLUMNS = ['cod_autorizado', 'qtd_curtidas', 'qtd_descurtidas']
+
+def load_enquetes_incremental():
+    formulario_model = get_model('EnqueteFormularioPublicado')
+    resposta_model = get_model('EnqueteResposta')
+    item_model = get_model('EnqueteItemResposta')
+    posicionamento_model = get_model('EnquetePosicionamento')
+
+    since = datetime.datetime.now() - datetime.timedelta(days=settings.DATALOADER_ENQUETES_RESYNC_DAYS)
 
-        for model in models_list:
-            target_table_name = model._meta.db_table
+    with connections['default'].cursor() as cursor, \
+         live_tables(cursor, [formulario_model, resposta_model, item_model, posicionamento_model]) as target_tables:
 
-            cursor.execute('ALTER TABLE public."%s" DISABLE TRIGGER ALL;' % (target_table_name,))
-            cursor.execute('DELETE FROM public."%s"' % (target_table_name,))
+        last_resposta = local_watermark(cursor, target_tables[resposta_model], 'ide_resposta') or 0
+        last_item = local_watermark(cursor, target_tables[item_model], 'ide_item_resposta') or 0
+        last_posicionamento = local_watermark(cursor, target_tables[posicionamento_model], 'ide_posicionamento') or 0
 
-            instance_list = []
+        # Rows the load touches: the posicionamentos re-synced, and new
+        # respostas and posicionamentos (empty before the load)
+        resposta_where = ('"ide_resposta" > %s', [last_resposta])
+        posicionamento_where = ('"ide_posicionamento" > %s OR "dat_posicionamento" >= %s', [last_posicionamento, since])
 
-            for _, _, _, qs in batch_qs(model.objects.using('enquetes')):
-                instance_list = []
+        posicionamento_fingerprint_args = (target_tables[posicionamento_model], 'dat_posicionamento', ['ide_formulario_publicado', 'cod_autorizado'])
+        posicionamento_fingerprints_before = date_fingerprints(cursor, *posicionamento_fingerprint_args, *posicionamento_where)
 
-                for instance_values in qs.values():
-                    instance_list.append(
-                        model(**instance_values)
-                    )
+        # Formularios are few, and their end dates may change
+        replicate_table(cursor, 'enquetes', ReplicatedTable(formulario_model), target_tables[formulario_model],
+            update_columns=[field.column for field in formulario_model._meta.concrete_fields if not field.primary_key])
 
-                model.objects.using('default').bulk_create(instance_list)
+        new_respostas = replicate_table(cursor, 'enquetes', ReplicatedTable(resposta_model), target_tables[resposta_model],
+            *resposta_where)
+        new_itens = replicate_table(cursor, 'enquetes', ReplicatedTable(item_model), target_tables[item_model],
+            '"ide_item_resposta" > %s', [last_item])
+        posicionamentos = replicate_table(cursor, 'enquetes', ReplicatedTable(posicionamento_model), target_tables[posicionamento_model],
+            *posicionamento_where, update_columns=ENQUETE_POSICIONAMENTO_MODERATION_COLUMNS)
 
-            cursor.execute('ALTER TABLE public."%s" ENABLE TRIGGER ALL;' % (target_table_name,))
+        # New respostas only add votes, so their days are enough
+        cursor.execute('SELECT DISTINCT "dat_resposta"::date FROM public."{}" WHERE "dat_resposta" IS NOT NULL AND ({})'.format(
+            target_tables[resposta_model], resposta_where[0]), resposta_where[1])
+        mark_dirty_dates(['proposicoes'], [date for date, in cursor.fetchall()])
+        mark_dirty_dates(['proposicoes'], changed_dates(posicionamento_fingerprints_before,
+            date_fingerprints(cursor, *posicionamento_fingerprint_args, *posicionamento_where)))
 
-            print('Loaded %s' % (target_table_name,))
+    print('Loaded enquetes incrementally: %d respostas, %d itens, %d new or re-synced posicionamentos' % (
+        new_respostas, new_itens, posicionamentos))
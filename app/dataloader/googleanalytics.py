@@ -1,207 +1,589 @@
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
 import datetime
+import glob
+import gzip
+import itertools
 import json
+import os
+import pandas as pd
+import threading
+import time
 import tenacity
 import re
 import requests
 import urllib.parse
+import uuid
 
 from django.conf import settings
+from django.core.cache import cache
 from django.db import connections, transaction, IntegrityError
 
 from oauth2client.service_account import ServiceAccountCredentials
 
 from .common import *
-from .noticias import load_noticia
+from .noticias import load_noticias
+
+# Google Analytics access token, shared by every process through the Django
+# cache until ANALYTICS_TOKEN_EXPIRY_MARGIN seconds before it expires
+ANALYTICS_TOKEN_CACHE_KEY = 'dataloader:analytics_access_token'
+ANALYTICS_TOKEN_LOCK_KEY = 'dataloader:analytics_access_token:lock'
+ANALYTICS_TOKEN_EXPIRY_MARGIN = 300
+
+access_token_lock = threading.Lock()
+
+# Shared by every thread querying GA (see get_analytics_rate_limiter)
+analytics_rate_limiter = None
+analytics_rate_limiter_lock = threading.Lock()
+
+# Serializes writes to the GA response archive (see archive_analytics_response)
+analytics_archive_lock = threading.Lock()
+
+# Rows per GA query page (the API maximum)
+ANALYTICS_PAGE_SIZE = 10000
+
+# GA filters (OR'ed) and page path patterns of each content type
+ANALYTICS_FILTERS = {
+    'fichas': 'ga:pagePath=~^/proposicoesWeb/fichadetramitacao,ga:pagePath=~^/propostas-legislativas/',
+    'noticias': 'ga:pagePath=~^/noticias/[0-9],ga:pagePath=~^/radio/programas/[0-9],ga:pagePath=~^/radio/radioagencia/[0-9],ga:pagePath=~^/tv/[0-9]',
+}
+PAGE_PATH_PATTERNS = {
+    'fichas': [
+        r'/proposicoesWeb/fichadetramitacao\?.*idProposicao=([0-9]+)',
+        r'/propostas-legislativas/([0-9]+)',
+    ],
+    'noticias': [
+        r'/noticias/([0-9]+)',
+        r'/radio/programas/([0-9]+)',
+        r'/radio/radioagencia/([0-9]+)',
+        r'/tv/([0-9]+)',
+    ],
+}
+
+# All of PAGE_PATH_PATTERNS as a single pattern, with one named group per
+# pattern (PAGE_PATH_GROUPS maps group names to content types). The patterns
+# start with different prefixes, so at most one group matches a page path.
+PAGE_PATH_GROUPS = {
+    '%s_%d' % (content_type, i): content_type
+    for content_type, patterns in PAGE_PATH_PATTERNS.items()
+    for i in range(len(patterns))
+}
+PAGE_PATH_PATTERN = re.compile('^(?:%s)' % '|'.join(
+    pattern.replace('(', '(?P<%s_%d>' % (content_type, i), 1)
+    for content_type, patterns in PAGE_PATH_PATTERNS.items()
+    for i, pattern in enumerate(patterns)
+))
+
+def get_access_token():
+    """
+    Returns a GA access token from the Django cache, minting a new one when
+    there is none. Only one thread of one process refreshes the token at a
+    time (a cache.add lock), the others wait for it to show up in the cache,
+    so parallel loaders don't stampede the OAuth endpoint. Tokens are cached
+    until shortly before they expire, so they are refreshed proactively.
+    """
+    access_token = cache.get(ANALYTICS_TOKEN_CACHE_KEY)
+    if access_token:
+        return access_token
+
+    with access_token_lock:
+        while True:
+            access_token = cache.get(ANALYTICS_TOKEN_CACHE_KEY)
+            if access_token:
+                return access_token
+
+            if cache.add(ANALYTICS_TOKEN_LOCK_KEY, True, timeout=60):
+                try:
+                    token_info = ServiceAccountCredentials.from_json_keyfile_dict(
+                        json.loads(settings.ANALYTICS_CREDENTIALS), 'https://www.googleapis.com/auth/analytics.readonly').get_access_token()
+
+                    cache.set(ANALYTICS_TOKEN_CACHE_KEY, token_info.access_token,
+                        timeout=max(token_info.expires_in - ANALYTICS_TOKEN_EXPIRY_MARGIN, 1))
+
+                    return token_info.access_token
+                finally:
+                    cache.delete(ANALYTICS_TOKEN_LOCK_KEY)
+
+            # Another process is refreshing the token
+            time.sleep(0.5)
 
-# Google Analytics access token
-access_token = None
+def invalidate_access_token(access_token):
+    # Only if no other thread already replaced it
+    if cache.get(ANALYTICS_TOKEN_CACHE_KEY) == access_token:
+        cache.delete(ANALYTICS_TOKEN_CACHE_KEY)
+
+def get_analytics_rate_limiter():
+    """
+    Returns the TokenBucket shared by every GA query of this process, created
+    on first use so that it follows the current settings.
+    """
+    global analytics_rate_limiter
+
+    with analytics_rate_limiter_lock:
+        if not analytics_rate_limiter:
+            analytics_rate_limiter = TokenBucket(settings.ANALYTICS_REQUESTS_PER_SECOND)
+
+        return analytics_rate_limiter
 
 @tenacity.retry(**TENACITY_ARGUMENTS)
-def get_analytics(date, metrics, dimensions, sort, filters, start_index, max_results):
-    global access_token
+def get_analytics(start_date, end_date, metrics, dimensions, sort, filters, start_index, max_results, run_id=None):
+    """
+    Runs a single GA query (one page of results). Failed requests are
+    retried on their own, and every attempt waits for the rate limiter
+    (ANALYTICS_REQUESTS_PER_SECOND), so it is safe to call from many threads.
+
+    run_id identifies the pages fetched together as one result set, and is
+    archived along with the response (see archive_analytics_response).
+    """
+    analytics_rate_limiter = get_analytics_rate_limiter()
+
+    query = {
+        'start_date': start_date.strftime("%Y-%m-%d"),
+        'end_date': end_date.strftime("%Y-%m-%d"),
+        'metrics': metrics,
+        'dimensions': dimensions,
+        'sort': sort,
+        'filters': filters,
+        'start_index': start_index,
+        'max_results': max_results,
+    }
 
-    if not access_token:
-        access_token = ServiceAccountCredentials.from_json_keyfile_dict(
-            json.loads(settings.ANALYTICS_CREDENTIALS), 'https://www.googleapis.com/auth/analytics.readonly').get_access_token().access_token
-    
     url = ('https://www.googleapis.com/analytics/v3/data/ga'
         +'?ids=ga%3A48889682'
-        +'&start-date='+date.strftime("%Y-%m-%d")
-        +'&end-date='+date.strftime("%Y-%m-%d")
+        +'&start-date='+query['start_date']
+        +'&end-date='+query['end_date']
         +'&metrics='+urllib.parse.quote(metrics)
         +'&dimensions='+urllib.parse.quote(dimensions)
         +'&sort='+urllib.parse.quote(sort)
         +'&filters='+urllib.parse.quote(filters)
         +'&start-index='+str(start_index)
-        +'&max-results='+str(max_results)
-        +'&access_token='+access_token)
+        +'&max-results='+str(max_results))
 
-    r = requests.get(url)
+    access_token = get_access_token()
+
+    analytics_rate_limiter.acquire()
+    r = requests.get(url+'&access_token='+access_token)
     data = r.json()
 
+    if data.get('error', {}).get('code') == 401:
+        # 401: Unauthorized (the token was revoked or expired early). Retried
+        # right away with a new token instead of waiting for tenacity.
+        invalidate_access_token(access_token)
+
+        analytics_rate_limiter.acquire()
+        r = requests.get(url+'&access_token='+get_access_token())
+        data = r.json()
+
+    # An empty result has no rows at all
+    if data.get('totalResults') == 0:
+        data.setdefault('rows', [])
+
     # There should always be rows. Otherwise something went wrong.
     try:
         data['rows']
     except KeyError:
         print(data)
-
-        try:
-            if data['error']['code'] == 401:
-                # 401: Unauthorized (most likely invalid credentials)
-                access_token = None
-                print('New access token probably needed. Will be tried next time.')
-        except KeyError:
-            pass
-
         raise
 
-    return data
+    archive_analytics_response(query, data, run_id)
 
-@tenacity.retry(**TENACITY_ARGUMENTS)
-def load_analytics_fichas(initial_date=None):
-    proposicao_ids = set(get_model('Proposicao').objects.values_list('id', flat=True))
+    return data
 
+def archive_analytics_response(query, data, run_id=None):
+    """
+    Appends a GA response, along with the query it answers and the run_id of
+    its result set, to the archive file of the query start date under
+    ANALYTICS_ARCHIVE_DIR (one gzip JSON line per response), so that it can
+    be replayed by load_analytics_archive.
+    """
+    if not settings.ANALYTICS_ARCHIVE_DIR:
+        return
+
+    path = os.path.join(settings.ANALYTICS_ARCHIVE_DIR, query['start_date'][:4], query['start_date'] + '.jsonl.gz')
+    line = json.dumps({'archived_at': datetime.datetime.now().isoformat(), 'run_id': run_id, 'query': query, 'data': data})
+
+    with analytics_archive_lock:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Every append is a gzip member of its own, gzip reads them as one file
+        with gzip.open(path, 'at', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+def read_analytics_archive():
+    """
+    Yields the archived responses (dicts with archived_at, run_id, query and
+    data) of pageviews queries, oldest files first. run_id is None for the
+    responses archived before run ids existed.
+    """
+    if not settings.ANALYTICS_ARCHIVE_DIR:
+        return
+
+    for path in sorted(glob.glob(os.path.join(settings.ANALYTICS_ARCHIVE_DIR, '*', '*.jsonl.gz'))):
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                record = json.loads(line)
+
+                if record['query']['metrics'] == 'ga:pageviews' and record['query']['dimensions'] == 'ga:pagePath,ga:date':
+                    record.setdefault('run_id', None)
+                    yield record
+
+def classify_pageviews(rows, content_types):
+    """
+    Classifies GA rows ([pagePath, date, pageviews], i.e. data['rows'] of a
+    pageviews query) with PAGE_PATH_PATTERN. Returns a Series of pageviews
+    indexed by (date, content_type, content_id), summed over every page path
+    of the same content, for the given content types only.
+    """
+    df = pd.DataFrame(rows, columns=['page_path', 'date', 'pageviews'])
+
+    # One row per matching page path, (row number, group name) -> id
+    matches = df['page_path'].str.extract(PAGE_PATH_PATTERN).stack().dropna()
+    row_numbers = matches.index.get_level_values(0)
+
+    classified = pd.DataFrame({
+        'date': df['date'].to_numpy()[row_numbers],
+        'content_type': matches.index.get_level_values(1).map(PAGE_PATH_GROUPS),
+        'content_id': matches.to_numpy().astype('int64'),
+        'pageviews': df['pageviews'].to_numpy()[row_numbers].astype('int64'),
+    })
+    classified = classified[classified['content_type'].isin(content_types)]
+
+    return classified.groupby(['date', 'content_type', 'content_id'])['pageviews'].sum()
+
+def benchmark_classify_pageviews(n_rows=1000000, page_size=ANALYTICS_PAGE_SIZE):
+    """
+    Times classify_pageviews over a synthetic GA dump of n_rows rows, split
+    in pages of page_size rows as get_pageviews gets them. Run it from
+    manage.py shell.
+    """
+    page_paths = [
+        '/proposicoesWeb/fichadetramitacao?idProposicao=%d',
+        '/proposicoesWeb/fichadetramitacao?ord=1&idProposicao=%d#tramitacao',
+        '/propostas-legislativas/%d',
+        '/noticias/%d-titulo-da-noticia/',
+        '/radio/programas/%d-titulo-do-programa',
+        '/radio/radioagencia/%d-titulo-da-noticia',
+        '/tv/%d-titulo-do-video',
+        '/deputados/%d',
+    ]
+    rows = [
+        [page_paths[i % len(page_paths)] % (i % 50000), '202001%02d' % (i % 28 + 1), str(i % 100 + 1)]
+        for i in range(n_rows)
+    ]
+
+    start = time.perf_counter()
+    pageviews = pd.concat([
+        classify_pageviews(rows[i:i+page_size], ('fichas', 'noticias'))
+        for i in range(0, n_rows, page_size)
+    ]).groupby(level=[0, 1, 2]).sum()
+    elapsed = time.perf_counter() - start
+
+    print('Classified %d rows into %d pageviews in %.2fs (%.0f rows/s)' % (n_rows, len(pageviews), elapsed, n_rows / elapsed))
+
+def pageviews_dict(pageviews):
+    """
+    Turns a Series as returned by classify_pageviews into a {(date,
+    content_type): Counter({id: pageviews})} dict.
+    """
+    result = defaultdict(Counter)
+
+    for (date, content_type), content_pageviews in pageviews.groupby(level=[0, 1]):
+        result[(datetime.datetime.strptime(date, "%Y%m%d").date(), content_type)] = Counter(dict(zip(
+            content_pageviews.index.get_level_values(2).tolist(),
+            content_pageviews.tolist()
+        )))
+
+    return result
+
+def get_pageviews_page(start_date, end_date, content_types, start_index, run_id):
+    return get_analytics(
+        start_date=start_date,
+        end_date=end_date,
+        metrics='ga:pageviews',
+        dimensions='ga:pagePath,ga:date',
+        sort='-ga:pageviews',
+        filters=','.join(ANALYTICS_FILTERS[content_type] for content_type in content_types),
+        start_index=start_index,
+        max_results=ANALYTICS_PAGE_SIZE,
+        run_id=run_id,
+    )
+
+def submit_pageviews_first_page(executor, start_date, end_date, content_types):
+    """
+    Submits the first page of a pageviews query to executor, under a new run
+    id. Returns a (run_id, future) tuple, to be given to get_pageviews.
+    """
+    run_id = uuid.uuid4().hex
+
+    return run_id, executor.submit(get_pageviews_page, start_date, end_date, content_types, 1, run_id)
+
+def get_pageviews(executor, start_date, end_date, content_types, first_page=None):
+    """
+    Returns the pageviews of the given content types ('fichas', 'noticias')
+    from start_date to end_date as a {(date, content_type): Counter({id:
+    pageviews})} dict.
+
+    A single query covers the whole range, with ga:date as a dimension and
+    the filters of every content type combined. Once the first page (which
+    may be given as already submitted by submit_pageviews_first_page) tells
+    totalResults, the remaining pages are fetched in parallel on executor,
+    under the same run id. Ranges whose
+    results GA samples are split in halves, so that the numbers are the
+    same as the ones of day by day queries.
+    """
+    if first_page is None:
+        first_page = submit_pageviews_first_page(executor, start_date, end_date, content_types)
+
+    run_id, first_page = first_page
+    data = first_page.result()
+
+    if data.get('containsSampledData') and start_date < end_date:
+        middle_date = start_date + datetime.timedelta(days=(end_date - start_date).days // 2)
+        halves = [(start_date, middle_date), (middle_date + datetime.timedelta(days=1), end_date)]
+        first_pages = [submit_pageviews_first_page(executor, start, end, content_types) for start, end in halves]
+
+        pageviews = defaultdict(Counter)
+        for (start, end), half_first_page in zip(halves, first_pages):
+            pageviews.update(get_pageviews(executor, start, end, content_types, half_first_page))
+        return pageviews
+
+    next_pages = [
+        executor.submit(get_pageviews_page, start_date, end_date, content_types, start_index, run_id)
+        for start_index in range(1 + ANALYTICS_PAGE_SIZE, data.get('totalResults', 0) + 1, ANALYTICS_PAGE_SIZE)
+    ]
+
+    pages = itertools.chain([data], (future.result() for future in next_pages))
+    pageviews = pd.concat([classify_pageviews(page['rows'], content_types) for page in pages])
+
+    # A content may show up in more than one page, under different page paths
+    pageviews = pageviews.groupby(level=[0, 1, 2]).sum()
+
+    return pageviews_dict(pageviews)
+
+def get_analytics_daterange(initial_date=None):
     if not initial_date:
         # By default the last 3 months
-        daterange = [datetime.date.today() - datetime.timedelta(days=i) for i in range(1,93)]
+        return [datetime.date.today() - datetime.timedelta(days=i) for i in range(1,93)]
     else:
-        daterange = [datetime.date.today() - datetime.timedelta(days=i) for i in range(1,(datetime.date.today() - initial_date).days + 1)]
+        return [datetime.date.today() - datetime.timedelta(days=i) for i in range(1,(datetime.date.today() - initial_date).days + 1)]
+
+def get_date_windows(dates, max_days):
+    """
+    Splits dates into (start_date, end_date) windows of consecutive days,
+    each at most max_days long, most recent first.
+    """
+    windows = []
+
+    for date in sorted(dates, reverse=True):
+        if windows and windows[-1][0] - date == datetime.timedelta(days=1) and (windows[-1][1] - date).days < max_days:
+            windows[-1] = (date, windows[-1][1])
+        else:
+            windows.append((date, date))
+
+    return windows
+
+def save_ficha_pageviews(date, pageviews_dict, proposicao_ids):
+    rows = [
+        (proposicao_id, date, pageviews)
+        for proposicao_id, pageviews in pageviews_dict.items()
+        if proposicao_id in proposicao_ids
+    ]
+
+    # Re-synced days replace the pageviews loaded before
+    with connections['default'].cursor() as cursor:
+        copy_rows(cursor, get_model('ProposicaoFichaPageviews')._meta.db_table, ['proposicao_id', 'date', 'pageviews'], rows,
+            conflict_columns=['proposicao_id', 'date'], update_columns=['pageviews'])
+
+    mark_dirty_dates(['proposicoes'], [date])
+    
+    print('Loaded ficha analytics %s' % (date,))
 
-    for date in daterange:
-        with transaction.atomic():
-            if get_model('ProposicaoFichaPageviews').objects.filter(date=date).count() > 0:
-                continue
-
-            pageviews_dict = {}
-            
-            i = 1
-            while (True):
-                data = get_analytics(
-                    date=date,
-                    metrics='ga:pageviews',
-                    dimensions='ga:pagePath,ga:date',
-                    sort='-ga:pageviews',
-                    filters='ga:pagePath=~^/proposicoesWeb/fichadetramitacao,ga:pagePath=~^/propostas-legislativas/',
-                    start_index=i,
-                    max_results=10000
-                )
-
-                for row in data['rows']:
-                    page_path = row[0]
-                    date = datetime.datetime.strptime(row[1], "%Y%m%d").date()
-                    pageviews = int(row[2])
-
-                    id_proposicao = None
-
-                    r = re.search('^/proposicoesWeb/fichadetramitacao\?.*idProposicao=([0-9]+)', page_path)
-                    if r:
-                        id_proposicao = int(r.group(1))
-
-                    r = re.search('^/propostas-legislativas/([0-9]+)', page_path)
-                    if r:
-                        id_proposicao = int(r.group(1))
-                    pageviews_dict[id_proposicao] = pageviews_dict.get(id_proposicao, 0) + pageviews
+def save_noticia_pageviews(date, pageviews_dict, noticia_ids):
+    rows = [
+        (noticia_id, date, pageviews)
+        for noticia_id, pageviews in pageviews_dict.items()
+        if noticia_id in noticia_ids
+    ]
 
-                try:
-                    data['nextLink']
-                    i += 10000
-                except KeyError:
-                    break
-            proposicao_ficha_pageview_list = []
-            for proposicao_id, pageviews in pageviews_dict.items():
-                if proposicao_id in proposicao_ids:
-                    proposicao_ficha_pageview_list.append(get_model('ProposicaoFichaPageviews')(
-                        proposicao_id=proposicao_id,
-                        pageviews=pageviews,
-                        date=date
-                    ))
-
-            get_model('ProposicaoFichaPageviews').objects.bulk_create(proposicao_ficha_pageview_list)
-            
-            print('Loaded ficha analytics %s' % (date,))
+    # Re-synced days replace the pageviews loaded before
+    with connections['default'].cursor() as cursor:
+        copy_rows(cursor, get_model('NoticiaPageviews')._meta.db_table, ['noticia_id', 'date', 'pageviews'], rows,
+            conflict_columns=['noticia_id', 'date'], update_columns=['pageviews'])
 
+    mark_dirty_dates(['noticias', 'proposicoes'], [date])
+    
+    print('Loaded noticias analytics %s' % (date,))
+
+def load_analytics(initial_date=None, content_types=('fichas', 'noticias')):
+    """
+    Loads the pageviews of the given content types for every day (the last
+    3 months, or since initial_date) that doesn't have them yet, plus the last
+    ANALYTICS_RESYNC_DAYS days, whose numbers GA may still be completing and
+    are always re-fetched (and overwritten). Days are
+    queried in windows of up to ANALYTICS_WINDOW_DAYS consecutive days, one
+    GA query per window for all content types, and stored day by day.
+
+    Queries run on ANALYTICS_CONCURRENCY threads: the first pages of the next
+    windows are fetched while the current one is paginated and stored.
+    """
+    daterange = get_analytics_daterange(initial_date)
+    models = {
+        'fichas': get_model('ProposicaoFichaPageviews'),
+        'noticias': get_model('NoticiaPageviews'),
+    }
+
+    resync_date = datetime.date.today() - datetime.timedelta(days=settings.ANALYTICS_RESYNC_DAYS)
+
+    # A single query per content type tells the days already loaded
+    pending_dates = {}
+    for content_type in content_types:
+        loaded_dates = set(models[content_type].objects.filter(date__in=daterange).values_list('date', flat=True).distinct())
+        pending_dates[content_type] = {date for date in daterange if date not in loaded_dates or date >= resync_date}
+
+    proposicao_ids = set(get_model('Proposicao').objects.values_list('id', flat=True))
+    deputado_ids = set(get_model('Deputado').objects.values_list('id', flat=True))
+    noticia_ids = set(get_model('Noticia').objects.values_list('id', flat=True))
+
+    # Noticias the web service doesn't know, not requested again in this load
+    missing_noticia_ids = set()
+
+    windows = []
+    for start_date, end_date in get_date_windows(set().union(*pending_dates.values()), settings.ANALYTICS_WINDOW_DAYS):
+        window_dates = [end_date - datetime.timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+        window_content_types = [
+            content_type for content_type in content_types
+            if any(date in pending_dates[content_type] for date in window_dates)
+        ]
+        windows.append((start_date, end_date, window_dates, window_content_types))
+
+    with ThreadPoolExecutor(settings.ANALYTICS_CONCURRENCY) as executor:
+        def submit_first_page(window):
+            start_date, end_date, _, window_content_types = window
+            return window, submit_pageviews_first_page(executor, start_date, end_date, window_content_types)
+
+        windows = iter(windows)
+        pending = deque(submit_first_page(window) for window in itertools.islice(windows, settings.ANALYTICS_CONCURRENCY))
+
+        while pending:
+            (start_date, end_date, window_dates, window_content_types), first_page = pending.popleft()
+            pending.extend(submit_first_page(window) for window in itertools.islice(windows, 1))
+
+            pageviews = get_pageviews(executor, start_date, end_date, window_content_types, first_page)
+
+            if 'noticias' in window_content_types:
+                # Noticias are loaded the first time they are encountered (and
+                # fetched again later by refresh_noticias)
+                new_noticia_ids = {
+                    noticia_id
+                    for date in window_dates if date in pending_dates['noticias']
+                    for noticia_id in pageviews[(date, 'noticias')]
+                    if noticia_id and noticia_id not in noticia_ids and noticia_id not in missing_noticia_ids
+                }
+                loaded_noticia_ids = load_noticias(new_noticia_ids, proposicao_ids, deputado_ids)
+                noticia_ids |= loaded_noticia_ids
+                missing_noticia_ids |= new_noticia_ids - loaded_noticia_ids
+
+            for date in window_dates:
+                with transaction.atomic():
+                    if date in pending_dates.get('fichas', ()):
+                        save_ficha_pageviews(date, pageviews[(date, 'fichas')], proposicao_ids)
+                    if date in pending_dates.get('noticias', ()):
+                        save_noticia_pageviews(date, pageviews[(date, 'noticias')], noticia_ids)
+
+def load_analytics_fichas(initial_date=None):
+    load_analytics(initial_date=initial_date, content_types=('fichas',))
 
-@tenacity.retry(**TENACITY_ARGUMENTS)
 def load_analytics_noticias(initial_date=None):
     print('Loading noticias analytics')
 
-    if not initial_date:
-        # By default the last 3 months
-        daterange = [datetime.date.today() - datetime.timedelta(days=i) for i in range(1,93)]
-    else:
-        daterange = [datetime.date.today() - datetime.timedelta(days=i) for i in range(1,(datetime.date.today() - initial_date).days + 1)]
+    load_analytics(initial_date=initial_date, content_types=('noticias',))
+
+def load_analytics_archive(initial_date=None, content_types=('fichas', 'noticias')):
+    """
+    Rebuilds the pageviews of the given content types (every archived day, or
+    since initial_date) from the GA responses archived by get_analytics,
+    without querying GA. A day is rebuilt from the most recently archived
+    run of a query that covers it completely (every page of one result set,
+    and no sampled data), and its existing pageviews are replaced. Noticias
+    that aren't loaded yet are skipped, not fetched from the web service.
+
+    Responses archived without a run id count as a single run per query,
+    only used when all of its pages report the same totalResults.
+    """
+    print('Loading analytics from archive')
+
+    # The pages of every archived run of every query, (start_date, end_date,
+    # filters, run_id) -> {start_index: page}, keeping the latest copy of each
+    runs = defaultdict(dict)
+    for record in read_analytics_archive():
+        query = record['query']
+        run = (query['start_date'], query['end_date'], query['filters'], record['run_id'])
+        page = runs[run].get(query['start_index'])
+
+        if not page or page['archived_at'] < record['archived_at']:
+            runs[run][query['start_index']] = {
+                'archived_at': record['archived_at'],
+                'max_results': query['max_results'],
+                'total_results': record['data'].get('totalResults', 0),
+                'sampled': record['data'].get('containsSampledData', False),
+            }
+
+    # (date, content_type) -> the run it is rebuilt from
+    sources = {}
+    runs_archived_at = {}
+    for run, run_pages in runs.items():
+        start_date, end_date, filters, _ = run
+        first_page = run_pages.get(1)
+
+        if not first_page or (first_page['sampled'] and start_date < end_date):
+            continue
+
+        # Every page the first one splits the results in, of the same result set
+        start_indexes = range(1, first_page['total_results'] + 1, first_page['max_results'])
+        if any(i not in run_pages for i in start_indexes) or \
+           any(page['total_results'] != first_page['total_results'] for page in run_pages.values()):
+            continue
+
+        runs_archived_at[run] = max(page['archived_at'] for page in run_pages.values())
+        query_content_types = [content_type for content_type in content_types if ANALYTICS_FILTERS[content_type] in filters]
+        date = datetime.date.fromisoformat(start_date)
+
+        while date <= datetime.date.fromisoformat(end_date):
+            if not initial_date or date >= initial_date:
+                for content_type in query_content_types:
+                    source = sources.get((date, content_type))
+
+                    if not source or runs_archived_at[source] < runs_archived_at[run]:
+                        sources[(date, content_type)] = run
+
+            date += datetime.timedelta(days=1)
+
+    # run -> the (date, content_type) it is the source of
+    selected = defaultdict(set)
+    for (date, content_type), source in sources.items():
+        selected[source].add((date.strftime("%Y%m%d"), content_type))
+
+    pageviews = []
+    for record in read_analytics_archive():
+        query = record['query']
+        run = (query['start_date'], query['end_date'], query['filters'], record['run_id'])
+
+        if run in selected and runs[run][query['start_index']]['archived_at'] == record['archived_at']:
+            record_pageviews = classify_pageviews(record['data']['rows'], content_types)
+            pageviews.append(record_pageviews[record_pageviews.index.droplevel(2).isin(list(selected[run]))])
+
+    pageviews = pageviews_dict(pd.concat(pageviews).groupby(level=[0, 1, 2]).sum()) if pageviews else {}
 
-    updated_noticias = set()
+    proposicao_ids = set(get_model('Proposicao').objects.values_list('id', flat=True))
+    deputado_ids = set(get_model('Deputado').objects.values_list('id', flat=True))
+    noticia_ids = set(get_model('Noticia').objects.values_list('id', flat=True))
 
-    for date in daterange:
+    for date, content_type in sorted(sources):
         with transaction.atomic():
-            if get_model('NoticiaPageviews').objects.filter(date=date).count() > 0:
-                continue
-
-            pageviews_dict = {}
-            
-            i = 1
-            while (True):
-                data = get_analytics(
-                    date=date,
-                    metrics='ga:pageviews',
-                    dimensions='ga:pagePath,ga:date',
-                    sort='-ga:pageviews',
-                    filters='ga:pagePath=~^/noticias/[0-9],ga:pagePath=~^/radio/programas/[0-9],ga:pagePath=~^/radio/radioagencia/[0-9],ga:pagePath=~^/tv/[0-9]',
-                    start_index=i,
-                    max_results=10000
-                )
-
-                for row in data['rows']:
-                    page_path = row[0]
-                    # date = datetime.datetime.strptime(row[1], "%Y%m%d").date()
-                    pageviews = int(row[2])
-
-                    id_noticia = None
-
-                    r = re.search('^/noticias/([0-9]+).*', page_path)
-                    if r:
-                        id_noticia = int(r.group(1))
-
-                    r = re.search('^/radio/programas/([0-9]+).*', page_path)
-                    if r:
-                        id_noticia = int(r.group(1))
-
-                    r = re.search('^/radio/radioagencia/([0-9]+).*', page_path)
-                    if r:
-                        id_noticia = int(r.group(1))
-
-                    r = re.search('^/tv/([0-9]+).*', page_path)
-                    if r:
-                        id_noticia = int(r.group(1))
-
-                    pageviews_dict[id_noticia] = pageviews_dict.get(id_noticia, 0) + pageviews
-
-                try:
-                    data['nextLink']
-                    i += 10000
-                except KeyError:
-                    break
-            
-            noticia_pageviews_list = []
-            noticia_ids = set(get_model('Noticia').objects.values_list('id', flat=True))
-
-            for noticia_id, pageviews in pageviews_dict.items():
-                if noticia_id:
-                    # TODO: Currently noticia is only pulled from web service the first time it's encountered
-                    # It would be desirable to re-fetch every once in a while (or even every new encounter)
-                    if noticia_id not in noticia_ids:
-                        if not load_noticia(noticia_id):
-                            continue
-                        noticia_ids.add(noticia_id)
-                    
-                    noticia_pageviews_list.append(get_model('NoticiaPageviews')(
-                        noticia_id=noticia_id,
-                        pageviews=pageviews,
-                        date=date
-                    ))
-
-
-        get_model('NoticiaPageviews').objects.bulk_create(noticia_pageviews_list)
-        
-        print('Loaded noticias analytics %s' % (date,))
+            if content_type == 'fichas':
+                get_model('ProposicaoFichaPageviews').objects.filter(date=date).delete()
+                save_ficha_pageviews(date, pageviews.get((date, content_type), {}), proposicao_ids)
+            else:
+                get_model('NoticiaPageviews').objects.filter(date=date).delete()
+                save_noticia_pageviews(date, pageviews.get((date, content_type), {}), noticia_ids)
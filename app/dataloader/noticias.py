@@ -1,14 +1,50 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
 import datetime
+import hashlib
+import itertools
 import json
 import requests
+import threading
 
 import tenacity
 
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Sum
+from django.db.models.functions import Coalesce
+
 from .common import *
 
+# Shared by every thread fetching noticias (see get_noticias_session)
+noticias_session = None
+noticias_session_lock = threading.Lock()
+
+def get_noticias_session():
+    """
+    Returns the HTTP session noticias are fetched through, with a connection
+    pool as large as DATALOADER_NOTICIAS_WORKERS so that concurrent fetches
+    reuse connections.
+    """
+    global noticias_session
+
+    with noticias_session_lock:
+        if not noticias_session:
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=settings.DATALOADER_NOTICIAS_WORKERS)
+            noticias_session = requests.Session()
+            noticias_session.mount('https://', adapter)
+            noticias_session.mount('http://', adapter)
+
+    return noticias_session
+
 @tenacity.retry(**TENACITY_ARGUMENTS_FAST)
-def load_noticia(id):
-    r = requests.get("https://camaranews.camara.leg.br/wp-json/conteudo-portal/{}".format(str(id)))
+def fetch_noticia(id):
+    """
+    Returns the JSON of a noticia from the portal web service, or None when it
+    doesn't exist.
+    """
+    r = get_noticias_session().get("https://camaranews.camara.leg.br/wp-json/conteudo-portal/{}".format(str(id)))
 
     # This is a huge kludge because the \u0000 character is invalid in JSON strings.
     # requests .json() will let this slip by.
@@ -16,17 +52,11 @@ def load_noticia(id):
     j = json.loads(c)
 
     if not id or j.get('code') == 'not_found':
-        return False
+        return None
 
-    noticia_id = j.get('id')
-    tipo_conteudo = j.get('tipo_conteudo')
-    link = j.get('link')
-    titulo = j.get('titulo')
-    data = j.get('data')
-    data_atualizacao = j.get('data_atualizacao')
-    conteudo = j.get('conteudo')
-    resumo = j.get('resumo')
+    return j
 
+def get_noticia_proposicoes_ids(j):
     # Salvar toda proposta associada à notícia
     proposicoes_ids = set()
 
@@ -48,68 +78,219 @@ def load_noticia(id):
         for p in projetos_de_lei:
             proposicoes_ids.add(int(p))
 
-    proposicoes_list = []
-    for p in proposicoes_ids:
-        try:
-            proposicoes_list.append(get_model('Proposicao').objects.get(pk=p))
-        except get_model('Proposicao').DoesNotExist:
-            pass
-    
-    # Salvar todo deputado associado à notícia
-    deputados_list = []
-    if j.get('deputados'):
-        for d in j.get('deputados'):
-            try:
-                deputados_list.append(get_model('Deputado').objects.get(pk=d))
-            except get_model('Deputado').DoesNotExist:
-                pass
+    return proposicoes_ids
+
+# Columns of Noticia and NoticiaConteudo written from the web service, and the
+# m2m tables of Noticia as (field name, column of the related id)
+NOTICIA_COLUMNS = ['id', 'tipo_conteudo', 'link', 'titulo', 'data', 'data_atualizacao', 'resumo', 'tema_principal_id']
+NOTICIA_CONTEUDO_COLUMNS = ['noticia_id', 'conteudo', 'raw_data']
+NOTICIA_RELATIONS = [('proposicoes', 'proposicao_id'), ('deputados', 'deputado_id'), ('tags_conteudo', 'noticiatag_id')]
+
+def fetch_noticias(ids):
+    """
+    Fetches the given noticias on DATALOADER_NOTICIAS_WORKERS threads.
+    Returns the JSON of the ones that exist.
+    """
+    with ThreadPoolExecutor(settings.DATALOADER_NOTICIAS_WORKERS) as executor:
+        return [j for j in executor.map(fetch_noticia, ids) if j]
+
+def parse_noticias(noticias, proposicao_ids, deputado_ids):
+    """
+    Turns the JSON of noticias into the rows to write: a dict with the
+    'noticias' ({id: row following NOTICIA_COLUMNS}), 'conteudos' ({id: row
+    following NOTICIA_CONTEUDO_COLUMNS}), 'temas' ({id: (id,
+    titulo)}) and 'tags' ({id: (id, nome, slug)}) rows, and a set of
+    (noticia_id, related id) pairs for each of NOTICIA_RELATIONS. Proposicoes
+    and deputados not in the proposicao_ids and deputado_ids sets (the ones
+    loaded) are left out.
+    """
+    rows = {'noticias': {}, 'conteudos': {}, 'temas': {}, 'tags': {}, 'proposicoes': set(), 'deputados': set(), 'tags_conteudo': set()}
+
+    for j in noticias:
+        noticia_id = j.get('id')
 
-    tema_principal = None
-    if j.get('tema_principal'):
-        try:
-            tema_id = j.get('tema_principal')['id']
-            tema_titulo = j.get('tema_principal')['titulo']
-        except KeyError:
-            tema_id = None
-    
-        if tema_id:
+        tema_principal_id = None
+        if j.get('tema_principal'):
             try:
-                tema_principal = get_model('NoticiaTema').objects.get(pk=tema_id)
-            except NoticiaTema.DoesNotExist:
-                tema_principal = get_model('NoticiaTema').objects.create(pk=tema_id, titulo=tema_titulo)
-    
-    tags_conteudo_list = []
-    if j.get('tags_conteudo'):
-        for tag in j.get('tags_conteudo'):
+                tema_principal_id = j.get('tema_principal')['id']
+                rows['temas'].setdefault(tema_principal_id, (tema_principal_id, j.get('tema_principal')['titulo']))
+            except KeyError:
+                tema_principal_id = None
+
+        for tag in j.get('tags_conteudo') or []:
             try:
-                tag_id = tag['id']
-                tag_nome = tag['nome']
-                tag_slug = tag['slug']
+                rows['tags'].setdefault(tag['id'], (tag['id'], tag['nome'], tag['slug']))
+                rows['tags_conteudo'].add((noticia_id, tag['id']))
             except KeyError:
-                tag_id = None
-
-            if tag_id:
-                try:
-                    noticia_tag = get_model('NoticiaTag').objects.get(pk=tag_id)
-                except get_model('NoticiaTag').DoesNotExist:
-                    noticia_tag = get_model('NoticiaTag').objects.create(pk=tag_id, nome=tag_nome, slug=tag_slug)
-            tags_conteudo_list.append(noticia_tag)
-
-
-    noticia = get_model('Noticia').objects.create(
-        pk = noticia_id,
-        tipo_conteudo = tipo_conteudo,
-        link = link,
-        titulo = titulo,
-        data = datetime.datetime.utcfromtimestamp(data) if data else None,
-        data_atualizacao = datetime.datetime.utcfromtimestamp(data_atualizacao) if data_atualizacao else None,
-        conteudo = conteudo,
-        resumo = resumo,
-        tema_principal = tema_principal,
-        raw_data = j
-    )
-    noticia.proposicoes.set(proposicoes_list)
-    noticia.deputados.set(deputados_list)
-    noticia.tags_conteudo.set(tags_conteudo_list)
-
-    return True
+                pass
+
+        for p in get_noticia_proposicoes_ids(j):
+            if p in proposicao_ids:
+                rows['proposicoes'].add((noticia_id, p))
+
+        # Salvar todo deputado associado à notícia
+        for d in j.get('deputados') or []:
+            if int(d) in deputado_ids:
+                rows['deputados'].add((noticia_id, int(d)))
+
+        data = j.get('data')
+        data_atualizacao = j.get('data_atualizacao')
+
+        rows['noticias'][noticia_id] = (
+            noticia_id,
+            j.get('tipo_conteudo'),
+            j.get('link'),
+            j.get('titulo'),
+            datetime.datetime.utcfromtimestamp(data) if data else None,
+            datetime.datetime.utcfromtimestamp(data_atualizacao) if data_atualizacao else None,
+            j.get('resumo'),
+            tema_principal_id,
+        )
+        rows['conteudos'][noticia_id] = (noticia_id, j.get('conteudo'), j)
+
+    return rows
+
+def write_noticias(cursor, rows, update=False):
+    """
+    Writes rows as returned by parse_noticias with a single bulk insert per
+    table (Noticia and NoticiaConteudo included). New temas, tags and
+    relations are added to the existing ones. With update, the given
+    noticias, temas and tags are overwritten instead of skipped when they
+    already exist.
+    """
+    noticia_model = get_model('Noticia')
+
+    copy_rows(cursor, get_model('NoticiaTema')._meta.db_table, ['id', 'titulo'], rows['temas'].values(),
+        conflict_columns=['id'], update_columns=['titulo'] if update else None)
+    copy_rows(cursor, get_model('NoticiaTag')._meta.db_table, ['id', 'nome', 'slug'], rows['tags'].values(),
+        conflict_columns=['id'], update_columns=['nome', 'slug'] if update else None)
+    copy_rows(cursor, noticia_model._meta.db_table, NOTICIA_COLUMNS, rows['noticias'].values(),
+        conflict_columns=['id'], update_columns=NOTICIA_COLUMNS[1:] if update else None)
+    copy_rows(cursor, get_model('NoticiaConteudo')._meta.db_table, NOTICIA_CONTEUDO_COLUMNS, rows['conteudos'].values(),
+        conflict_columns=['noticia_id'], update_columns=NOTICIA_CONTEUDO_COLUMNS[1:] if update else None)
+
+    for field_name, column in NOTICIA_RELATIONS:
+        copy_rows(cursor, getattr(noticia_model, field_name).through._meta.db_table, ['noticia_id', column], rows[field_name],
+            conflict_columns=['noticia_id', column])
+
+def load_noticias(ids, proposicao_ids=None, deputado_ids=None):
+    """
+    Loads the given noticias from the portal web service, fetched concurrently
+    on DATALOADER_NOTICIAS_WORKERS threads. Proposicoes and deputados are
+    looked up in the proposicao_ids and deputado_ids sets (the ones not
+    loaded are left out), read from the database when not given, so callers
+    loading noticias repeatedly should pass them. Noticias, tags, temas and
+    the three m2m tables are written with a single bulk insert each.
+
+    Returns the set of ids loaded (noticias that don't exist are not).
+    """
+    ids = sorted(set(ids))
+    if not ids:
+        return set()
+
+    if proposicao_ids is None:
+        proposicao_ids = set(get_model('Proposicao').objects.values_list('id', flat=True))
+    if deputado_ids is None:
+        deputado_ids = set(get_model('Deputado').objects.values_list('id', flat=True))
+
+    noticias = fetch_noticias(ids)
+    rows = parse_noticias(noticias, proposicao_ids, deputado_ids)
+
+    with transaction.atomic(), connections['default'].cursor() as cursor:
+        write_noticias(cursor, rows)
+
+    print('Loaded %d noticias (%d not found)' % (len(rows['noticias']), len(ids) - len(noticias)))
+
+    return set(rows['noticias'])
+
+def noticia_content_hash(j):
+    return hashlib.md5(json.dumps(j, sort_keys=True).encode()).hexdigest()
+
+def get_noticias_to_refresh(limit):
+    """
+    Returns up to limit ids of noticias worth fetching again: the ones updated
+    (or published) in the last DATALOADER_NOTICIAS_REFRESH_DAYS days, most
+    recent first, alternated with the ones with the most pageviews in the
+    same period.
+    """
+    since = datetime.date.today() - datetime.timedelta(days=settings.DATALOADER_NOTICIAS_REFRESH_DAYS)
+
+    recent_ids = get_model('Noticia').objects \
+        .annotate(updated=Coalesce('data_atualizacao', 'data')) \
+        .filter(updated__gte=since) \
+        .order_by('-updated') \
+        .values_list('id', flat=True)[:limit]
+
+    popular_ids = get_model('NoticiaPageviews').objects \
+        .filter(date__gte=since) \
+        .values('noticia_id') \
+        .annotate(total_pageviews=Sum('pageviews')) \
+        .order_by('-total_pageviews') \
+        .values_list('noticia_id', flat=True)[:limit]
+
+    ids = {}
+    for pair in itertools.zip_longest(recent_ids, popular_ids):
+        for id in pair:
+            if id is not None:
+                ids.setdefault(id, None)
+
+    return list(ids)[:limit]
+
+def refresh_noticias(limit=None):
+    """
+    Fetches again the noticias that may have been edited since they were
+    loaded (see get_noticias_to_refresh), at most limit of them
+    (DATALOADER_NOTICIAS_REFRESH_LIMIT by default), and rewrites the ones
+    whose content hash differs from the stored raw_data: their row, temas and
+    tags, and only the relations that were added or removed. Dates with
+    pageviews of noticias whose proposicoes changed are marked for the
+    proposicoes preprocessor.
+    """
+    if limit is None:
+        limit = settings.DATALOADER_NOTICIAS_REFRESH_LIMIT
+
+    ids = get_noticias_to_refresh(limit)
+    stored_hashes = {
+        id: noticia_content_hash(raw_data)
+        for id, raw_data in get_model('NoticiaConteudo').objects.filter(noticia_id__in=ids).values_list('noticia_id', 'raw_data')
+    }
+
+    noticias = [j for j in fetch_noticias(ids) if noticia_content_hash(j) != stored_hashes.get(j.get('id'))]
+    rows = parse_noticias(noticias,
+        set(get_model('Proposicao').objects.values_list('id', flat=True)),
+        set(get_model('Deputado').objects.values_list('id', flat=True)))
+    changed_ids = set(rows['noticias'])
+
+    noticia_model = get_model('Noticia')
+
+    with transaction.atomic(), connections['default'].cursor() as cursor:
+        relations_changed_ids = defaultdict(set)
+
+        # Only the relations added or removed are written
+        for field_name, column in NOTICIA_RELATIONS:
+            through_model = getattr(noticia_model, field_name).through
+
+            stored = {
+                (noticia_id, related_id): through_id
+                for through_id, noticia_id, related_id in through_model.objects.filter(noticia_id__in=changed_ids).values_list('id', 'noticia_id', column)
+            }
+            removed = set(stored) - rows[field_name]
+            rows[field_name] -= set(stored)
+
+            through_model.objects.filter(id__in=[stored[pair] for pair in removed]).delete()
+
+            for noticia_id, _ in removed | rows[field_name]:
+                relations_changed_ids[field_name].add(noticia_id)
+
+        write_noticias(cursor, rows, update=True)
+
+        mark_dirty_dates(['proposicoes'], get_model('NoticiaPageviews').objects
+            .filter(noticia_id__in=relations_changed_ids['proposicoes'])
+            .values_list('date', flat=True)
+            .distinct())
+
+    print('Refreshed noticias: %d fetched, %d changed, %d with changed relations' % (
+        len(ids), len(changed_ids), len(set().union(*relations_changed_ids.values()))))
+
+def load_noticia(id):
+    return id in load_noticias([id])
@@ -1,221 +1,393 @@
 from collections import defaultdict
 
+import contextlib
 import datetime
 
 from django.db import connections, transaction
-from django.db.models import Count
+from django.db.models import Count, Q
 
 from .common import *
 
+# Each source is pre-aggregated by (proposicao, day) and the outer GROUP BY
+# merges them, so every (proposicao, day) pair gets exactly one row. Comment
+# buckets are conditional aggregates over cod_autorizado (0: unchecked,
+# 1: authorized, 2: unauthorized). When dates is not NULL only those days
+# are computed.
+PROPOSICAO_AGGREGATED_SQL = '''
+INSERT INTO public."{table_name}" (
+    proposicao_id, date,
+    ficha_pageviews, noticia_pageviews, poll_votes,
+    poll_comments, poll_comments_unchecked, poll_comments_checked,
+    poll_comments_authorized, poll_comments_unauthorized)
+SELECT
+    proposicao_id, date,
+    SUM(ficha_pageviews), SUM(noticia_pageviews), SUM(poll_votes),
+    SUM(poll_comments), SUM(poll_comments_unchecked), SUM(poll_comments_checked),
+    SUM(poll_comments_authorized), SUM(poll_comments_unauthorized)
+FROM (
+    SELECT
+        f.proposicao_id, f.date,
+        f.pageviews AS ficha_pageviews, 0 AS noticia_pageviews, 0 AS poll_votes,
+        0 AS poll_comments, 0 AS poll_comments_unchecked, 0 AS poll_comments_checked,
+        0 AS poll_comments_authorized, 0 AS poll_comments_unauthorized
+    FROM app_proposicaofichapageviews f
+    WHERE f.date >= %(initial_date)s AND f.date < %(final_date)s
+      AND (%(dates)s::date[] IS NULL OR f.date = ANY(%(dates)s))
+
+    UNION ALL
+
+    SELECT
+        np.proposicao_id, n.date,
+        0, SUM(n.pageviews), 0,
+        0, 0, 0,
+        0, 0
+    FROM app_noticiapageviews n
+    JOIN app_noticia_proposicoes np ON np.noticia_id = n.noticia_id
+    WHERE n.date >= %(initial_date)s AND n.date < %(final_date)s
+      AND (%(dates)s::date[] IS NULL OR n.date = ANY(%(dates)s))
+    GROUP BY np.proposicao_id, n.date
+
+    UNION ALL
+
+    SELECT
+        p.id, date_trunc('day', r.dat_resposta)::date,
+        0, 0, COUNT(r.ide_resposta),
+        0, 0, 0,
+        0, 0
+    FROM "Resposta" r
+    JOIN app_proposicao p ON p.formulario_publicado_id = r.ide_formulario_publicado
+    WHERE r.dat_resposta >= %(initial_date)s AND r.dat_resposta < %(final_date)s
+      AND (%(dates)s::date[] IS NULL OR date_trunc('day', r.dat_resposta)::date = ANY(%(dates)s))
+    GROUP BY p.id, date_trunc('day', r.dat_resposta)
+
+    UNION ALL
+
+    SELECT
+        p.id, date_trunc('day', c.dat_posicionamento)::date,
+        0, 0, 0,
+        COUNT(c.ide_posicionamento),
+        COUNT(c.ide_posicionamento) FILTER (WHERE c.cod_autorizado = 0),
+        COUNT(c.ide_posicionamento) FILTER (WHERE c.cod_autorizado IN (1, 2)),
+        COUNT(c.ide_posicionamento) FILTER (WHERE c.cod_autorizado = 1),
+        COUNT(c.ide_posicionamento) FILTER (WHERE c.cod_autorizado = 2)
+    FROM "Posicionamento" c
+    JOIN app_proposicao p ON p.formulario_publicado_id = c.ide_formulario_publicado
+    WHERE c.dat_posicionamento >= %(initial_date)s AND c.dat_posicionamento < %(final_date)s
+      AND (%(dates)s::date[] IS NULL OR date_trunc('day', c.dat_posicionamento)::date = ANY(%(dates)s))
+    GROUP BY p.id, date_trunc('day', c.dat_posicionamento)
+) AS sources
+GROUP BY proposicao_id, date
+'''
+
+def get_dirty_dates(target, full=False):
+    """
+    Returns the set of dates the loaders marked as touched for target (see
+    PreprocessDirtyDate). Returns None when full is set, meaning the whole
+    history has to be rebuilt.
+
+    Marks are left in place: the caller clears the dates it recomputed with
+    clear_dirty_dates, in the same transaction, so that dates outside the
+    range it preprocesses (like today) are kept for a later run.
+    """
+    if full:
+        return None
+
+    return set(get_model('PreprocessDirtyDate').objects.filter(target=target).values_list('date', flat=True))
+
+def clear_dirty_dates(target, dates, initial_date):
+    """
+    Clears the marks of target for the given dates, and the ones before
+    initial_date, which are never preprocessed.
+    """
+    get_model('PreprocessDirtyDate').objects \
+        .filter(target=target) \
+        .filter(Q(date__in=dates) | Q(date__lt=initial_date)) \
+        .delete()
+
+@contextlib.contextmanager
+def replace_dates(cursor, model, dates):
+    """
+    Empties the rows of model's table for the given dates and points model to
+    it while the block refills them. When dates is None the whole table is
+    rebuilt through replace_tables (so into a shadow table when
+    settings.DATALOADER_SHADOW_TABLES is set). Yields the table name.
+    """
+    if dates is None:
+        with replace_tables(cursor, [model]) as target_tables:
+            with model_table(model, target_tables[model]):
+                yield target_tables[model]
+    else:
+        table_name = model._meta.db_table
+
+        cursor.execute('ALTER TABLE public."%s" DISABLE TRIGGER ALL;' % (table_name,))
+        cursor.execute('DELETE FROM public."%s" WHERE date = ANY(%%s)' % (table_name,), [dates])
+
+        yield table_name
+
+        cursor.execute('ALTER TABLE public."%s" ENABLE TRIGGER ALL;' % (table_name,))
+
 @transaction.atomic
-def preprocess_proposicoes():
-    with connections['default'].cursor() as cursor:  
-        cursor.execute('ALTER TABLE app_proposicaoaggregated DISABLE TRIGGER ALL;')
-        cursor.execute('DELETE FROM app_proposicaoaggregated')
+def preprocess_proposicoes(engine='sql', full=False):
+    """
+    Rebuilds app_proposicaoaggregated from pageviews, poll votes and poll
+    comments. The 'sql' engine does it with a single INSERT ... SELECT, while
+    the 'python' engine runs the original day by day loop (handy for checking
+    that both produce the same rows).
+
+    Unless full is set, only the dates marked as dirty by the loaders are
+    recomputed.
+    """
+    if engine not in ('sql', 'python'):
+        raise ValueError('Unknown preprocess engine: %s' % (engine,))
 
+    with connections['default'].cursor() as cursor:  
         initial_date = datetime.date(year=2019, month=1, day=1)
         daterange = [datetime.date.today() - datetime.timedelta(days=i) for i in range(1, (datetime.date.today() - initial_date).days + 1)]
-        for date in daterange:
-
-            aggregated_dict = defaultdict(lambda:{
-                'ficha_pageviews': 0, 
-                'noticia_pageviews': 0, 
-                'poll_votes': 0, 
-                'poll_comments': 0, 
-                'poll_comments_unchecked': 0, 
-                'poll_comments_checked': 0, 
-                'poll_comments_authorized': 0, 
-                'poll_comments_unauthorized': 0})
-
-            ficha_pageviews_qs = get_model('ProposicaoFichaPageviews').objects.filter(date=date)
-
-            for row in ficha_pageviews_qs:
-                aggregated_dict[row.proposicao_id]['ficha_pageviews'] = row.pageviews
-
-            noticia_pageviews_qs = get_model('NoticiaPageviews').objects \
-                .filter(date=date) \
-                .values('date', 'pageviews', 'noticia__proposicoes__pk')
-
-            for row in noticia_pageviews_qs:
-                proposicao_id = row['noticia__proposicoes__pk']
-                pageviews = row['pageviews']
-
-                if proposicao_id:
-                    # Operator += is super important here
-                    # (since each proposicao has more than one noticia)
-                    aggregated_dict[proposicao_id]['noticia_pageviews'] += pageviews
-
-            # Poll votes
-            votes_qs = get_model('EnqueteResposta').objects \
-                .filter(dat_resposta__year=date.year) \
-                .filter(dat_resposta__month=date.month) \
-                .filter(dat_resposta__day=date.day) \
-                .values('ide_formulario_publicado__proposicao') \
-                .annotate(votes_count=Count('ide_resposta')) \
-                .values('ide_formulario_publicado__proposicao','votes_count')
-
-            for row in votes_qs:
-                if not row['ide_formulario_publicado__proposicao']:
-                    continue
-
-                proposicao_id = row['ide_formulario_publicado__proposicao']
-                poll_votes = row['votes_count']
-
-                aggregated_dict[proposicao_id]['poll_votes'] = poll_votes
-
-            # Poll comments
-            comment_status_mappings = [
-                ({}, 'poll_comments'),
-                ({'cod_autorizado': 0}, 'poll_comments_unchecked'),
-                ({'cod_autorizado__in': [1, 2]}, 'poll_comments_checked'),
-                ({'cod_autorizado': 1}, 'poll_comments_authorized'),
-                ({'cod_autorizado': 2}, 'poll_comments_unauthorized')
-            ]
-
-            for filter_args, target_field in comment_status_mappings:
-                comments_qs = get_model('EnquetePosicionamento').objects \
-                    .filter(dat_posicionamento__year=date.year) \
-                    .filter(dat_posicionamento__month=date.month) \
-                    .filter(dat_posicionamento__day=date.day) \
-                    .filter(**filter_args) \
-                    .values('ide_formulario_publicado__proposicao') \
-                    .annotate(comments_count=Count('ide_posicionamento')) \
-                    .values('ide_formulario_publicado__proposicao','comments_count')
-
-                for row in comments_qs:
-                    if not row['ide_formulario_publicado__proposicao']:
-                        continue
-
-                    proposicao_id = row['ide_formulario_publicado__proposicao']
-                    poll_comments = row['comments_count']
-
-                    aggregated_dict[proposicao_id][target_field] = poll_comments
-
-
-            aggregated_dict_list = [get_model('ProposicaoAggregated')(
-                proposicao_id=k,
-                date=date,
-                ficha_pageviews=v['ficha_pageviews'],
-                noticia_pageviews=v['noticia_pageviews'],
-                poll_votes=v['poll_votes'],
-                poll_comments=v['poll_comments'],
-                poll_comments_unchecked=v['poll_comments_unchecked'],
-                poll_comments_checked=v['poll_comments_checked'],
-                poll_comments_authorized=v['poll_comments_authorized'],
-                poll_comments_unauthorized=v['poll_comments_unauthorized'],
-                ) for k, v in aggregated_dict.items()]
-            get_model('ProposicaoAggregated').objects.bulk_create(aggregated_dict_list)
-
-        cursor.execute('ALTER TABLE app_proposicaoaggregated ENABLE TRIGGER ALL;')
+
+        # An empty table can only be filled by a full rebuild
+        dirty_dates = get_dirty_dates('proposicoes', full or not get_model('ProposicaoAggregated').objects.exists())
+
+        if dirty_dates is not None:
+            daterange = [date for date in daterange if date in dirty_dates]
+            if not daterange:
+                clear_dirty_dates('proposicoes', daterange, initial_date)
+                print('No proposicoes to preprocess')
+                return
+
+        target_dates = daterange if dirty_dates is not None else None
+
+        with replace_dates(cursor, get_model('ProposicaoAggregated'), target_dates) as table_name:
+            if engine == 'sql':
+                cursor.execute(PROPOSICAO_AGGREGATED_SQL.format(table_name=table_name), {
+                    'initial_date': min(daterange),
+                    'final_date': max(daterange) + datetime.timedelta(days=1),
+                    'dates': target_dates,
+                })
+            elif engine == 'python':
+                for date in daterange:
+
+                    aggregated_dict = defaultdict(lambda:{
+                        'ficha_pageviews': 0, 
+                        'noticia_pageviews': 0, 
+                        'poll_votes': 0, 
+                        'poll_comments': 0, 
+                        'poll_comments_unchecked': 0, 
+                        'poll_comments_checked': 0, 
+                        'poll_comments_authorized': 0, 
+                        'poll_comments_unauthorized': 0})
+
+                    ficha_pageviews_qs = get_model('ProposicaoFichaPageviews').objects.filter(date=date)
+
+                    for row in ficha_pageviews_qs:
+                        aggregated_dict[row.proposicao_id]['ficha_pageviews'] = row.pageviews
+
+                    noticia_pageviews_qs = get_model('NoticiaPageviews').objects \
+                        .filter(date=date) \
+                        .values('date', 'pageviews', 'noticia__proposicoes__pk')
+
+                    for row in noticia_pageviews_qs:
+                        proposicao_id = row['noticia__proposicoes__pk']
+                        pageviews = row['pageviews']
+
+                        if proposicao_id:
+                            # Operator += is super important here
+                            # (since each proposicao has more than one noticia)
+                            aggregated_dict[proposicao_id]['noticia_pageviews'] += pageviews
+
+                    # Poll votes
+                    votes_qs = get_model('EnqueteResposta').objects \
+                        .filter(dat_resposta__year=date.year) \
+                        .filter(dat_resposta__month=date.month) \
+                        .filter(dat_resposta__day=date.day) \
+                        .values('ide_formulario_publicado__proposicao') \
+                        .annotate(votes_count=Count('ide_resposta')) \
+                        .values('ide_formulario_publicado__proposicao','votes_count')
+
+                    for row in votes_qs:
+                        if not row['ide_formulario_publicado__proposicao']:
+                            continue
+
+                        proposicao_id = row['ide_formulario_publicado__proposicao']
+                        poll_votes = row['votes_count']
+
+                        aggregated_dict[proposicao_id]['poll_votes'] = poll_votes
+
+                    # Poll comments
+                    comment_status_mappings = [
+                        ({}, 'poll_comments'),
+                        ({'cod_autorizado': 0}, 'poll_comments_unchecked'),
+                        ({'cod_autorizado__in': [1, 2]}, 'poll_comments_checked'),
+                        ({'cod_autorizado': 1}, 'poll_comments_authorized'),
+                        ({'cod_autorizado': 2}, 'poll_comments_unauthorized')
+                    ]
+
+                    for filter_args, target_field in comment_status_mappings:
+                        comments_qs = get_model('EnquetePosicionamento').objects \
+                            .filter(dat_posicionamento__year=date.year) \
+                            .filter(dat_posicionamento__month=date.month) \
+                            .filter(dat_posicionamento__day=date.day) \
+                            .filter(**filter_args) \
+                            .values('ide_formulario_publicado__proposicao') \
+                            .annotate(comments_count=Count('ide_posicionamento')) \
+                            .values('ide_formulario_publicado__proposicao','comments_count')
+
+                        for row in comments_qs:
+                            if not row['ide_formulario_publicado__proposicao']:
+                                continue
+
+                            proposicao_id = row['ide_formulario_publicado__proposicao']
+                            poll_comments = row['comments_count']
+
+                            aggregated_dict[proposicao_id][target_field] = poll_comments
+
+
+                    aggregated_dict_list = [get_model('ProposicaoAggregated')(
+                        proposicao_id=k,
+                        date=date,
+                        ficha_pageviews=v['ficha_pageviews'],
+                        noticia_pageviews=v['noticia_pageviews'],
+                        poll_votes=v['poll_votes'],
+                        poll_comments=v['poll_comments'],
+                        poll_comments_unchecked=v['poll_comments_unchecked'],
+                        poll_comments_checked=v['poll_comments_checked'],
+                        poll_comments_authorized=v['poll_comments_authorized'],
+                        poll_comments_unauthorized=v['poll_comments_unauthorized'],
+                        ) for k, v in aggregated_dict.items()]
+                    get_model('ProposicaoAggregated').objects.bulk_create(aggregated_dict_list)
+
+        clear_dirty_dates('proposicoes', daterange, initial_date)
 
         print('Finished proposicoes preprocess')
 
 @transaction.atomic
-def preprocess_noticias():
+def preprocess_noticias(full=False):
     with connections['default'].cursor() as cursor:  
-        cursor.execute('ALTER TABLE app_noticiaaggregated DISABLE TRIGGER ALL;')
-        cursor.execute('DELETE FROM app_noticiaaggregated')
-
         initial_date = datetime.date(year=2019, month=1, day=1)
         daterange = [datetime.date.today() - datetime.timedelta(days=i) for i in range(1, (datetime.date.today() - initial_date).days + 1)]
-        for date in daterange:
-
-            aggregated_dict = defaultdict(lambda:{
-                'pageviews': 0, 
-                'portal_comments': 0,
-                'portal_comments_unchecked': 0,
-                'portal_comments_authorized': 0,
-                'portal_comments_unauthorized': 0})
-
-            # Pageviews
-            noticia_pageviews_qs = get_model('NoticiaPageviews').objects.filter(date=date)
-
-            for row in noticia_pageviews_qs:
-                aggregated_dict[row.noticia_id]['pageviews'] = row.pageviews
-
-            # Portal comments
-            comment_status_mappings = [
-                ({}, 'portal_comments'),
-                ({'situacao': 'PENDENTE'}, 'portal_comments_unchecked'),
-                ({'situacao': 'APROVADO'}, 'portal_comments_authorized'),
-                ({'situacao': 'REPROVADO'}, 'portal_comments_unauthorized')
-            ]
-
-            for filter_args, target_field in comment_status_mappings:
-
-                comments_qs = get_model('PortalComentario').objects \
-                    .filter(data__year=date.year) \
-                    .filter(data__month=date.month) \
-                    .filter(data__day=date.day) \
-                    .filter(**filter_args) \
-                    .values('url') \
-                    .annotate(comments_count=Count('id')) \
-                    .values('url', 'comments_count')
+
+        # An empty table can only be filled by a full rebuild
+        dirty_dates = get_dirty_dates('noticias', full or not get_model('NoticiaAggregated').objects.exists())
+
+        if dirty_dates is not None:
+            daterange = [date for date in daterange if date in dirty_dates]
+            if not daterange:
+                clear_dirty_dates('noticias', daterange, initial_date)
+                print('No noticias to preprocess')
+                return
+
+        target_dates = daterange if dirty_dates is not None else None
+
+        with replace_dates(cursor, get_model('NoticiaAggregated'), target_dates):
+            for date in daterange:
+
+                aggregated_dict = defaultdict(lambda:{
+                    'pageviews': 0, 
+                    'portal_comments': 0,
+                    'portal_comments_unchecked': 0,
+                    'portal_comments_authorized': 0,
+                    'portal_comments_unauthorized': 0})
+
+                # Pageviews
+                noticia_pageviews_qs = get_model('NoticiaPageviews').objects.filter(date=date)
+
+                for row in noticia_pageviews_qs:
+                    aggregated_dict[row.noticia_id]['pageviews'] = row.pageviews
+
+                # Portal comments
+                comment_status_mappings = [
+                    ({}, 'portal_comments'),
+                    ({'situacao': 'PENDENTE'}, 'portal_comments_unchecked'),
+                    ({'situacao': 'APROVADO'}, 'portal_comments_authorized'),
+                    ({'situacao': 'REPROVADO'}, 'portal_comments_unauthorized')
+                ]
+
+                for filter_args, target_field in comment_status_mappings:
+
+                    comments_qs = get_model('PortalComentario').objects \
+                        .filter(data__year=date.year) \
+                        .filter(data__month=date.month) \
+                        .filter(data__day=date.day) \
+                        .filter(**filter_args) \
+                        .values('url') \
+                        .annotate(comments_count=Count('id')) \
+                        .values('url', 'comments_count')
             
-                for row in comments_qs:
-                    if not row['url']:
-                        continue
+                    for row in comments_qs:
+                        if not row['url']:
+                            continue
 
-                    noticia_id = int(row['url'])
-                    poll_comments = row['comments_count']
+                        noticia_id = int(row['url'])
+                        poll_comments = row['comments_count']
 
-                    aggregated_dict[noticia_id][target_field] = poll_comments
+                        aggregated_dict[noticia_id][target_field] = poll_comments
 
 
-            aggregated_dict_list = [get_model('NoticiaAggregated')(
-                noticia_id=k,
-                date=date,
-                pageviews=v['pageviews'],
-                portal_comments=v['portal_comments'],
-                portal_comments_unchecked=v['portal_comments_unchecked'],
-                portal_comments_authorized=v['portal_comments_authorized'],
-                portal_comments_unauthorized=v['portal_comments_unauthorized'],
-                ) for k, v in aggregated_dict.items()]
-            get_model('NoticiaAggregated').objects.bulk_create(aggregated_dict_list)
+                aggregated_dict_list = [get_model('NoticiaAggregated')(
+                    noticia_id=k,
+                    date=date,
+                    pageviews=v['pageviews'],
+                    portal_comments=v['portal_comments'],
+                    portal_comments_unchecked=v['portal_comments_unchecked'],
+                    portal_comments_authorized=v['portal_comments_authorized'],
+                    portal_comments_unauthorized=v['portal_comments_unauthorized'],
+                    ) for k, v in aggregated_dict.items()]
+                get_model('NoticiaAggregated').objects.bulk_create(aggregated_dict_list)
 
-        cursor.execute('ALTER TABLE app_noticiaaggregated ENABLE TRIGGER ALL;')
+        clear_dirty_dates('noticias', daterange, initial_date)
 
         print('Finished noticias preprocess')
 
 
 
 @transaction.atomic
-def preprocess_daily_summary():
+def preprocess_daily_summary(full=False):
     with connections['default'].cursor() as cursor:  
-        cursor.execute('ALTER TABLE app_dailysummary DISABLE TRIGGER ALL;')
-        cursor.execute('DELETE FROM app_dailysummary')
-
         initial_date = datetime.date(year=2019, month=1, day=1)
         daterange = [datetime.date.today() - datetime.timedelta(days=i) for i in range(1, (datetime.date.today() - initial_date).days + 1)]
-        for date in daterange:
 
-            aggregated_dict = defaultdict(lambda:{
-                'atendimentos': 0, 
-            })
+        dirty_dates = get_dirty_dates('daily_summary', full)
+
+        if dirty_dates is not None:
+            # Every day has a summary row, so days without one are also due
+            existing_dates = set(get_model('DailySummary').objects.values_list('date', flat=True))
+            daterange = [date for date in daterange if date in dirty_dates or date not in existing_dates]
+            if not daterange:
+                clear_dirty_dates('daily_summary', daterange, initial_date)
+                print('No daily summary to preprocess')
+                return
+
+        target_dates = daterange if dirty_dates is not None else None
+
+        with replace_dates(cursor, get_model('DailySummary'), target_dates):
+            for date in daterange:
+
+                aggregated_dict = defaultdict(lambda:{
+                    'atendimentos': 0, 
+                })
 
-            # Demandas (Prisma)
-            demanda_canal_mappings = [
-                ({}, 'atendimentos'),
-            ]
+                # Demandas (Prisma)
+                demanda_canal_mappings = [
+                    ({}, 'atendimentos'),
+                ]
 
-            for filter_args, target_field in demanda_canal_mappings:
+                for filter_args, target_field in demanda_canal_mappings:
 
-                demandas_count = get_model('PrismaDemanda').objects \
-                    .filter(demanda_data_criação__year=date.year) \
-                    .filter(demanda_data_criação__month=date.month) \
-                    .filter(demanda_data_criação__day=date.day) \
-                    .filter(**filter_args) \
-                    .count()
+                    demandas_count = get_model('PrismaDemanda').objects \
+                        .filter(demanda_data_criação__year=date.year) \
+                        .filter(demanda_data_criação__month=date.month) \
+                        .filter(demanda_data_criação__day=date.day) \
+                        .filter(**filter_args) \
+                        .count()
             
-                aggregated_dict[target_field] = demandas_count
+                    aggregated_dict[target_field] = demandas_count
 
 
-            daily_summary = get_model('DailySummary')(
-                date=date,
-                atendimentos=aggregated_dict['atendimentos'],
-            )
-            get_model('DailySummary').objects.bulk_create([daily_summary])
+                daily_summary = get_model('DailySummary')(
+                    date=date,
+                    atendimentos=aggregated_dict['atendimentos'],
+                )
+                get_model('DailySummary').objects.bulk_create([daily_summary])
 
-        cursor.execute('ALTER TABLE app_dailysummary ENABLE TRIGGER ALL;')
+        clear_dirty_dates('daily_summary', daterange, initial_date)
 
         print('Finished daily summary preprocess')
@@ -5,133 +5,112 @@ import tenacity
 
 from .common import *
 
-
+# Views of the Prisma database, and the column of each one holding the id
+# incremental loads select rows by
+PRISMA_VIEWS = [
+    ('PrismaAssunto', '"SqlProPrisma"."dbo"."vwAssunto"', 'Assunto.IdDemanda'),
+    ('PrismaCategoria', '"SqlProPrisma"."dbo"."vwCategoria"', 'IdDemanda'),
+    ('PrismaDemanda', '"SqlProPrisma"."dbo"."vwDemanda"', 'IdDemanda'),
+    ('PrismaDemandante', '"SqlProPrisma"."dbo"."vwDemandante"', 'IdDemandante'),
+]
+
+# SQL Server takes at most 2100 parameters per query
+PRISMA_IDS_PER_QUERY = 1000
+
+def prisma_replicated_tables():
+    # The views expose the same column names as the models. Demandas and
+    # demandantes may be repeated in them, so only their first row is kept
+    return [
+        ReplicatedTable(get_model(model_name), source=source, ignore_conflicts=model_name in ('PrismaDemanda', 'PrismaDemandante'))
+        for model_name, source, _ in PRISMA_VIEWS
+    ]
 
 @tenacity.retry(**TENACITY_ARGUMENTS)
 @transaction.atomic
-def load_prisma():
+def load_prisma(full=None):
+    """
+    Loads the Prisma views. By default only the demandas created or updated
+    (Demanda.Data da Atualização) since the last load are fetched, and their
+    rows in the four tables (assuntos and categorias, and their demandantes)
+    are replaced. Every DATALOADER_FULL_SYNC_DAYS days (or with full) the
+    tables are reloaded from scratch instead, the four views being copied in
+    parallel into shadow tables (see replicate_tables_parallel).
+    """
     if 'prisma' not in settings.DATABASES:
         print('Prisma connection not available')
         return
- 
-    with connections['default'].cursor() as default_cursor, \
-         connections['prisma'].cursor() as prisma_cursor:
-
-        models_list = [
-            { 'model': get_model('PrismaAssunto'),
-              'table_name': '"SqlProPrisma"."dbo"."vwAssunto"',
-              'order_field': '"Assunto.IdDemanda"',
-              'fields':
-                [ \
-                    { 'django_field': 'assunto_iddemanda_id'                  , 'sql_server_field': 'Assunto.IdDemanda'                  } ,
-                    { 'django_field': 'assunto_nome'                          , 'sql_server_field': 'Assunto.Nome'                       } ,
-                ],
-            },
-            { 'model': get_model('PrismaCategoria'),
-              'table_name': '"SqlProPrisma"."dbo"."vwCategoria"',
-              'order_field': '"IdDemanda"',
-              'fields':
-                [ \
-                    { 'django_field': 'iddemanda_id'                             , 'sql_server_field': 'IdDemanda'                          } ,
-                    { 'django_field': 'macrotema'                             , 'sql_server_field': 'Macrotema'                          } ,
-                    { 'django_field': 'tema'                                  , 'sql_server_field': 'Tema'                               } ,
-                    { 'django_field': 'subtema'                               , 'sql_server_field': 'Subtema'                            } ,
-                    { 'django_field': 'categoria_posicionamento'              , 'sql_server_field': 'Categoria.Posicionamento'           } ,
-                    { 'django_field': 'categoria_legislativo'                 , 'sql_server_field': 'Categoria.Legislativo'              } ,
-                    { 'django_field': 'categoria_deputado'                    , 'sql_server_field': 'Categoria.Deputado'                 } ,
-                    { 'django_field': 'categoria_legislação'                  , 'sql_server_field': 'Categoria.Legislação'               } ,
-                    { 'django_field': 'categoria_debate_nacional'             , 'sql_server_field': 'Categoria.Debate Nacional'          } ,
-                    { 'django_field': 'categoria_orcamento'                   , 'sql_server_field': 'Categoria.Orçamento'                } ,
-                    { 'django_field': 'categoria_tema_proposição'             , 'sql_server_field': 'Categoria.Tema Proposição'          } ,
-                ],
-            },
-            { 'model': get_model('PrismaDemanda'),
-              'table_name': '"SqlProPrisma"."dbo"."vwDemanda"',
-              'order_field': '"IdDemanda"',
-              'fields':
-                [ \
-                    { 'django_field': 'iddemanda'                             , 'sql_server_field': 'IdDemanda'                          } ,
-                    { 'django_field': 'iddemandante_id'                       , 'sql_server_field': 'IdDemandante'                       } ,
-                    { 'django_field': 'demanda_protocolo'                     , 'sql_server_field': 'Demanda.Protocolo'                  } ,
-                    { 'django_field': 'demanda_fila'                          , 'sql_server_field': 'Demanda.Fila'                       } ,
-                    { 'django_field': 'demanda_prioridade'                    , 'sql_server_field': 'Demanda.Prioridade'                 } ,
-                    { 'django_field': 'demanda_canal'                         , 'sql_server_field': 'Demanda.Canal'                      } ,
-                    { 'django_field': 'demanda_tipo'                          , 'sql_server_field': 'Demanda.Tipo'                       } ,
-                    { 'django_field': 'demanda_data_criação'                  , 'sql_server_field': 'Demanda.Data Criação'               } ,
-                    { 'django_field': 'demanda_prazo'                         , 'sql_server_field': 'Demanda.Prazo'                      } ,
-                    { 'django_field': 'demanda_prazo_sugerido'                , 'sql_server_field': 'Demanda.Prazo Sugerido'             } ,
-                    { 'django_field': 'demanda_data_da_resposta'              , 'sql_server_field': 'Demanda.Data da Resposta'           } ,
-                    { 'django_field': 'demanda_tempo_em_aberto'               , 'sql_server_field': 'Demanda.Tempo em Aberto'            } ,
-                    { 'django_field': 'demanda_tempo_em_aberto_em_minutos'    , 'sql_server_field': 'Demanda.Tempo em Aberto em Minutos' } , 
-                    { 'django_field': 'demanda_tempo_de_trabalho'             , 'sql_server_field': 'Demanda.Tempo de Trabalho'          } ,
-                    { 'django_field': 'demanda_titulo'                        , 'sql_server_field': 'Demanda.Titulo'                     } ,
-                    { 'django_field': 'demanda_data_da_atualização'           , 'sql_server_field': 'Demanda.Data da Atualização'        } ,
-                    { 'django_field': 'demanda_status'                        , 'sql_server_field': 'Demanda.Status'                     } ,
-                    { 'django_field': 'demanda_forma_de_recebimento'          , 'sql_server_field': 'Demanda.Forma de Recebimento'       } ,
-                    { 'django_field': 'demanda_orgão_interessado'             , 'sql_server_field': 'Demanda.Orgão Interessado'          } ,
-                    { 'django_field': 'demanda_resultado_do_atendimento'      , 'sql_server_field': 'Demanda.Resultado do Atendimento'   } ,
-                ],
-            },
-            { 'model': get_model('PrismaDemandante'),
-              'table_name': '"SqlProPrisma"."dbo"."vwDemandante"',
-              'order_field': '"IdDemandante"',
-              'fields':
-                [ \
-                    { 'django_field': 'iddemandante'                          , 'sql_server_field': 'IdDemandante'                       } ,
-                    { 'django_field': 'demandante_data_cadastro'              , 'sql_server_field': 'Demandante.Data Cadastro'           } ,
-                    { 'django_field': 'demandante_grau_de_instrução'          , 'sql_server_field': 'Demandante.Grau de Instrução'       } ,
-                    { 'django_field': 'demandante_sexo'                       , 'sql_server_field': 'Demandante.Sexo'                    } ,
-                    { 'django_field': 'demandante_categoria'                  , 'sql_server_field': 'Demandante.Categoria'               } ,
-                    { 'django_field': 'demandante_data_de_nascimento'         , 'sql_server_field': 'Demandante.Data de Nascimento'      } ,
-                    { 'django_field': 'demandante_profissão_externa'          , 'sql_server_field': 'Demandante.Profissão Externa'       } ,
-                ],
-            },
-        ]
-
-        for model in models_list:
-            target_table_name = model['model']._meta.db_table
-
-            default_cursor.execute('ALTER TABLE public."%s" DISABLE TRIGGER ALL;' % (target_table_name,))
-            default_cursor.execute('DELETE FROM public."%s"' % (target_table_name,))
-
-            instance_list = []
-
-            fields_list = ', '.join(['"'+field['sql_server_field']+'"' for field in model['fields']])
-            table_name = model['table_name']
-            order_field = model['order_field']
-
-            num_rows = prisma_cursor.execute(f'SELECT COUNT(*) FROM '+model['table_name']).fetchone()[0]
-
-            for i in range(0,num_rows, 50000):
-                instance_list = []
-
-                # query = f"""
-                # SELECT {fields_list}
-                # FROM (
-                #     SELECT {fields_list}, ROW_NUMBER() OVER (ORDER BY {order_field}) AS RowNum
-                #     FROM {table_name}
-                # ) AS MyDerivedTable
-                # WHERE MyDerivedTable.RowNum BETWEEN {i} AND {i+50000}
-                # """
-                query = f"""
-                SELECT {fields_list}
-                FROM {table_name}
-                """
-                # import pdb;pdb.set_trace()
-                rows = prisma_cursor.execute(query).fetchall()[i:i+50000]
-
-                for row in rows:
-                    instance_values = {}
-                    for col_number, field in enumerate(model['fields']):
-                        instance_values[field['django_field']] = row[col_number]
-
-                    instance_list.append(
-                        model['model'](**instance_values)
-                    )
-
-                model['model'].objects.using('default').bulk_create(instance_list, ignore_conflicts=True)
-
-            default_cursor.execute('ALTER TABLE public."%s" ENABLE TRIGGER ALL;' % (target_table_name,))
-
-            print('Loaded %s' % (target_table_name,))
 
+    if full is None:
+        full = full_sync_due('prisma')
+
+    if full:
+        load_prisma_full()
+        record_full_sync('prisma')
+    else:
+        load_prisma_incremental()
+
+def load_prisma_full():
+    with connections['default'].cursor() as cursor:
+        # Columns that feed DailySummary
+        fingerprint_args = ('Demanda.Data Criação', ['IdDemanda'])
+        fingerprints_before = date_fingerprints(cursor, get_model('PrismaDemanda')._meta.db_table, *fingerprint_args)
+
+        with replicate_tables_parallel(cursor, 'prisma', prisma_replicated_tables()) as target_tables:
+            fingerprints_after = date_fingerprints(cursor, target_tables[get_model('PrismaDemanda')], *fingerprint_args)
+            mark_dirty_dates(['daily_summary'], changed_dates(fingerprints_before, fingerprints_after))
+
+def get_updated_prisma_demandas(last_iddemanda, last_update):
+    """
+    Returns the (IdDemanda, IdDemandante) pairs of the demandas past
+    last_iddemanda or updated since last_update (when given).
+    """
+    where = '"IdDemanda" > %s'
+    params = [last_iddemanda]
+    if last_update:
+        where += ' OR "Demanda.Data da Atualização" >= %s'
+        params.append(last_update)
+
+    with connections['prisma'].cursor() as prisma_cursor:
+        prisma_cursor.execute('''
+            SELECT DISTINCT "IdDemanda", "IdDemandante"
+            FROM "SqlProPrisma"."dbo"."vwDemanda"
+            WHERE {}
+        '''.format(where), params)
+
+        return prisma_cursor.fetchall()
+
+def load_prisma_incremental():
+    demanda_model = get_model('PrismaDemanda')
+    replicated_tables = prisma_replicated_tables()
+
+    with connections['default'].cursor() as cursor, \
+         live_tables(cursor, [replicated_table.model for replicated_table in replicated_tables]) as target_tables:
+
+        demanda_table = target_tables[demanda_model]
+        last_iddemanda = local_watermark(cursor, demanda_table, 'IdDemanda') or 0
+        last_update = local_watermark(cursor, demanda_table, 'Demanda.Data da Atualização')
+
+        demandas = get_updated_prisma_demandas(last_iddemanda, last_update)
+        ids = {
+            'IdDemanda': sorted({iddemanda for iddemanda, _ in demandas}),
+            'IdDemandante': sorted({iddemandante for _, iddemandante in demandas if iddemandante is not None}),
+        }
+
+        # Columns that feed DailySummary, only for the demandas replaced
+        fingerprint_args = (demanda_table, 'Demanda.Data Criação', ['IdDemanda'], '"IdDemanda" = ANY(%s)', [ids['IdDemanda']])
+        fingerprints_before = date_fingerprints(cursor, *fingerprint_args)
+
+        for replicated_table, (_, _, id_column) in zip(replicated_tables, PRISMA_VIEWS):
+            id_list = ids['IdDemandante' if id_column == 'IdDemandante' else 'IdDemanda']
+            table_name = target_tables[replicated_table.model]
+
+            cursor.execute('DELETE FROM public."{}" WHERE "{}" = ANY(%s)'.format(table_name, id_column), [id_list])
+
+            for start in range(0, len(id_list), PRISMA_IDS_PER_QUERY):
+                chunk = id_list[start:start + PRISMA_IDS_PER_QUERY]
+                replicate_table(cursor, 'prisma', replicated_table, table_name,
+                    '"{}" IN ({})'.format(id_column, ', '.join(['%s'] * len(chunk))), chunk)
+
+        mark_dirty_dates(['daily_summary'], changed_dates(fingerprints_before, date_fingerprints(cursor, *fingerprint_args)))
+
+    print('Loaded prisma incrementally: %d demandas, %d demandantes' % (len(ids['IdDemanda']), len(ids['IdDemandante'])))
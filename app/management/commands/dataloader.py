@@ -44,11 +44,26 @@ class Command(BaseCommand):
             action='store_true',
             help='Syncs analytics (noticias)'
         )
+        parser.add_argument(
+            '--from-archive',
+            action='store_true',
+            help='Rebuilds analytics (fichas and noticias, or the ones specified) from the archived Google Analytics responses, without querying it'
+        )
+        parser.add_argument(
+            '--refresh-noticias',
+            action='store_true',
+            help='Fetches again recently updated or viewed noticias'
+        )
         parser.add_argument(
             '--preprocess',
             action='store_true',
             help='Pre-processes data'
         )
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help='Reloads comentarios portal, enquetes and prisma from scratch and pre-processes the whole history instead of only the dates touched by the loaders'
+        )
         parser.add_argument(
             '--rebuild-cache',
             action='store_true',
@@ -70,6 +85,8 @@ class Command(BaseCommand):
             options['dados_abertos'],
             options['analytics_fichas'],
             options['analytics_noticias'],
+            options['from_archive'],
+            options['refresh_noticias'],
             options['preprocess'],
         ]):
             raise CommandError('No option specified.')
@@ -80,24 +97,33 @@ class Command(BaseCommand):
             initial_date = None
         
         if options['all'] or options['comentarios_portal']:
-            dataloader.load_comentarios_portal()
+            dataloader.load_comentarios_portal(full=options['full'] or None)
         if options['all'] or options['prisma']:
-            dataloader.load_prisma()
+            dataloader.load_prisma(full=options['full'] or None)
         if options['all'] or options['enquetes']:
-            dataloader.load_enquetes()
+            dataloader.load_enquetes(full=options['full'] or None)
         if options['all'] or options['dados_abertos']:
             dataloader.load_deputados()
             dataloader.load_orgaos()
             dataloader.load_proposicoes()
             dataloader.load_proposicoes_autores()
             dataloader.load_proposicoes_temas()
-        if options['all'] or options['analytics_fichas']:
+        if options['from_archive']:
+            if options['analytics_fichas'] != options['analytics_noticias']:
+                dataloader.load_analytics_archive(initial_date=initial_date, content_types=('fichas',) if options['analytics_fichas'] else ('noticias',))
+            else:
+                dataloader.load_analytics_archive(initial_date=initial_date)
+        elif options['all'] or (options['analytics_fichas'] and options['analytics_noticias']):
+            dataloader.load_analytics(initial_date=initial_date)
+        elif options['analytics_fichas']:
             dataloader.load_analytics_fichas(initial_date=initial_date)
-        if options['all'] or options['analytics_noticias']:
+        elif options['analytics_noticias']:
             dataloader.load_analytics_noticias(initial_date=initial_date)
+        if options['all'] or options['refresh_noticias']:
+            dataloader.refresh_noticias()
         if options['all'] or options['preprocess']:
-            dataloader.preprocess_daily_summary()
-            dataloader.preprocess_noticias()
-            dataloader.preprocess_proposicoes()
+            dataloader.preprocess_daily_summary(full=options['full'])
+            dataloader.preprocess_noticias(full=options['full'])
+            dataloader.preprocess_proposicoes(full=options['full'])
         if options['all'] or options['rebuild_cache']:
             cache.rebuild_caches()
@@ -5,5 +5,20 @@ from app import cache
 class Command(BaseCommand):
     help = 'Rebuilds cache'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--enqueue',
+            action='store_true',
+            help='Warms the cache on the celery workers and waits for them, instead of on local processes'
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            help='Number of processes (or celery tasks) warming the cache at once (default: CACHE_WARMING_CONCURRENCY)'
+        )
+
     def handle(self, *args, **options):
-        cache.rebuild_caches()
+        if options['enqueue']:
+            cache.wait_rebuild_caches(cache.enqueue_rebuild_caches(concurrency=options['concurrency']))
+        else:
+            cache.rebuild_caches(concurrency=options['concurrency'])
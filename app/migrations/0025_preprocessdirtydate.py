@@ -0,0 +1,24 @@
+# Generated by Django 3.2.25 on 2026-10-18 08:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0024_auto_20210225_2007'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PreprocessDirtyDate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('target', models.CharField(choices=[('proposicoes', 'ProposicaoAggregated'), ('noticias', 'NoticiaAggregated'), ('daily_summary', 'DailySummary')], max_length=100)),
+                ('date', models.DateField()),
+            ],
+            options={
+                'unique_together': {('target', 'date')},
+            },
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0025_preprocessdirtydate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DadosAbertosArquivo',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url', models.CharField(max_length=500, unique=True)),
+                ('year', models.IntegerField()),
+                ('checksum', models.CharField(max_length=64)),
+                ('row_count', models.IntegerField()),
+                ('loaded_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
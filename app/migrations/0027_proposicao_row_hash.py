@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0026_dadosabertosarquivo'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='proposicao',
+            name='row_hash',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+    ]
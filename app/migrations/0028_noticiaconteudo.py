@@ -0,0 +1,62 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:38
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0027_proposicao_row_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NoticiaConteudo',
+            fields=[
+                ('noticia', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='app.noticia')),
+                ('conteudo', models.TextField(blank=True, null=True)),
+                ('raw_data', django.contrib.postgres.fields.jsonb.JSONField(blank=True, null=True)),
+            ],
+        ),
+        # lz4 compresses faster than the default pglz (PostgreSQL 14+, when
+        # built with lz4)
+        migrations.RunSQL(
+            '''
+            DO $$
+            BEGIN
+                IF current_setting('server_version_num')::int >= 140000 THEN
+                    EXECUTE 'ALTER TABLE app_noticiaconteudo ALTER COLUMN conteudo SET COMPRESSION lz4, ALTER COLUMN raw_data SET COMPRESSION lz4';
+                END IF;
+            EXCEPTION WHEN feature_not_supported THEN
+                NULL;
+            END
+            $$
+            ''',
+            migrations.RunSQL.noop,
+        ),
+        migrations.RunSQL(
+            '''
+            INSERT INTO app_noticiaconteudo (noticia_id, conteudo, raw_data)
+            SELECT id, conteudo, raw_data FROM app_noticia
+            ''',
+            '''
+            UPDATE app_noticia SET conteudo = c.conteudo, raw_data = c.raw_data
+            FROM app_noticiaconteudo c WHERE c.noticia_id = app_noticia.id
+            ''',
+        ),
+        migrations.RemoveField(
+            model_name='noticia',
+            name='conteudo',
+        ),
+        migrations.RemoveField(
+            model_name='noticia',
+            name='raw_data',
+        ),
+        # Dropped columns stay in the rows until they are rewritten
+        migrations.RunSQL(
+            'CLUSTER app_noticia USING app_noticia_pkey',
+            migrations.RunSQL.noop,
+        ),
+    ]
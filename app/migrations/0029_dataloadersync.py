@@ -0,0 +1,21 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0028_noticiaconteudo'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DataloaderSync',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=100, unique=True)),
+                ('full_sync_at', models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -120,6 +120,9 @@ class Proposicao(models.Model):
     ultimo_status_relator = models.ForeignKey('Deputado', null=True, related_name='ultimo_status_relator', on_delete=models.SET_NULL)
     ultimo_status_orgao = models.ForeignKey('Orgao', null=True, on_delete=models.SET_NULL)
 
+    # Data loader internal: hash of the row as last loaded from dados abertos
+    row_hash = models.CharField(max_length=32, blank=True, null=True)
+
     def enquete_posicionamentos(self, order_by="-dat_posicionamento"):
         queryset = EnquetePosicionamento.objects.filter(ide_formulario_publicado=self.formulario_publicado)
         if order_by:
@@ -174,7 +177,6 @@ class Noticia(models.Model):
     tipo_conteudo = models.TextField(blank=True, null=True)
     link = models.TextField(blank=True, null=True)
     titulo = models.TextField(blank=True, null=True)
-    conteudo = models.TextField(blank=True, null=True)
     resumo = models.TextField(blank=True, null=True)
     data = models.DateTimeField(blank=True, null=True)
     data_atualizacao = models.DateTimeField(blank=True, null=True)
@@ -183,7 +185,7 @@ class Noticia(models.Model):
     tags_conteudo = models.ManyToManyField('NoticiaTag')
     tema_principal = models.ForeignKey('NoticiaTema', null=True, on_delete=models.CASCADE)
 
-    raw_data = JSONField(blank=True, null=True)
+    # conteudo and raw_data are kept in NoticiaConteudo
 
     class Meta:
         ordering = ['-data']
@@ -198,6 +200,16 @@ class Noticia(models.Model):
     def comments_unauthorized(self):
         return self.portalcomentario_set.filter(situacao='REPROVADO').aggregate(Count('id'))['id__count']
 
+class NoticiaConteudo(models.Model):
+    '''
+    The heavy columns of a Noticia (the article HTML and the full portal
+    payload), apart so that queries joining noticias don't read them. Loaded
+    on demand through noticia.noticiaconteudo.
+    '''
+    noticia = models.OneToOneField('Noticia', primary_key=True, on_delete=models.CASCADE)
+    conteudo = models.TextField(blank=True, null=True)
+    raw_data = JSONField(blank=True, null=True)
+
 class NoticiaTag(models.Model):
     nome = models.TextField(blank=True, null=True)
     slug = models.TextField(blank=True, null=True)
@@ -272,9 +284,11 @@ class NoticiaAggregatedManager(models.Manager):
             .order_by('-pageviews') \
             .values('noticia__id', 'noticia__titulo', 'noticia__link', 'noticia__tipo_conteudo', 'noticia__tema_principal__titulo', 'pageviews', 'portal_comments', 'portal_comments_unchecked', 'portal_comments_authorized', 'portal_comments_unauthorized')
 
-        # Dictionary of tags for speed
+        qs = list(qs[:500])
+
+        # Dictionary of tags for speed (of the listed noticias only)
         tags = {}
-        for n in Noticia.objects.all().values('id', 'tags_conteudo__nome'):
+        for n in Noticia.objects.filter(id__in=[q['noticia__id'] for q in qs]).values('id', 'tags_conteudo__nome'):
             if tags.get(n['id']):
                 tags[n['id']].append(n['tags_conteudo__nome'])
             else:
@@ -291,7 +305,7 @@ class NoticiaAggregatedManager(models.Manager):
                 'portal_comments_authorized': q['portal_comments_authorized'],
                 'portal_comments_unauthorized': q['portal_comments_unauthorized'],
                 'tipo_conteudo': q['noticia__tipo_conteudo']
-            } for q in qs[:500]]
+            } for q in qs]
 
 
 
@@ -458,6 +472,39 @@ class ProposicaoFichaPageviews(models.Model):
     class Meta:
         unique_together = ('proposicao', 'date')
 
+class PreprocessDirtyDate(models.Model):
+    '''
+    PRIVATE: This model is for data loader internal use only.
+    Dates touched by the loaders that still need to be preprocessed.
+    '''
+    class Targets(models.TextChoices):
+        PROPOSICOES = ('proposicoes', 'ProposicaoAggregated')
+        NOTICIAS = ('noticias', 'NoticiaAggregated')
+        DAILY_SUMMARY = ('daily_summary', 'DailySummary')
+    target = models.CharField(max_length=100, choices=Targets.choices)
+    date = models.DateField()
+    class Meta:
+        unique_together = ('target', 'date')
+
+class DadosAbertosArquivo(models.Model):
+    '''
+    PRIVATE: This model is for data loader internal use only.
+    Yearly dados abertos files as last loaded, so that unchanged years are skipped.
+    '''
+    url = models.CharField(max_length=500, unique=True)
+    year = models.IntegerField()
+    checksum = models.CharField(max_length=64)
+    row_count = models.IntegerField()
+    loaded_at = models.DateTimeField(auto_now=True)
+
+class DataloaderSync(models.Model):
+    '''
+    PRIVATE: This model is for data loader internal use only.
+    Last full reload of the sources that are otherwise loaded incrementally.
+    '''
+    source = models.CharField(max_length=100, unique=True)
+    full_sync_at = models.DateTimeField()
+
 class PrismaDemandante(models.Model):
     iddemandante = models.AutoField(db_column='IdDemandante', primary_key=True)
     demandante_data_cadastro = models.DateTimeField(db_column='Demandante.Data Cadastro', null=True)  # Field name made lowercase. Field renamed to remove unsuitable characters.
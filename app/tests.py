@@ -1,3 +1,135 @@
-from django.test import TestCase
+import datetime
+import functools
+import http.server
+import os
+import tempfile
+import threading
 
-# Create your tests here.
+from django.db import connection
+from django.test import TestCase, override_settings
+
+import tenacity
+
+from app.dataloader import dadosabertos
+from app.models import DadosAbertosArquivo, EnqueteFormularioPublicado, PreprocessDirtyDate, Proposicao, ProposicaoAggregated, Tema
+
+TEST_DATA_DIR = os.path.join(os.path.dirname(__file__), 'test_data')
+
+class QuietHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+class DadosAbertosTestCase(TestCase):
+    '''
+    Loads the yearly files of dados abertos from a local stand-in serving
+    test_data/dadosabertos, which has files for 2019 only (other years are
+    missing).
+    '''
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+
+        handler = functools.partial(QuietHTTPRequestHandler, directory=os.path.join(TEST_DATA_DIR, 'dadosabertos'))
+        cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+
+        settings_override = override_settings(
+            DADOS_ABERTOS_URL='http://127.0.0.1:%d' % self.server.server_address[1],
+            DADOS_ABERTOS_CACHE_DIR=cache_dir.name,
+            DATALOADER_DOWNLOAD_WORKERS=2,
+            DATALOADER_PARSE_WORKERS=2,
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def load(self, loader):
+        loader.retry_with(stop=tenacity.stop_after_attempt(1))()
+
+    def test_load_proposicoes(self):
+        self.load(dadosabertos.load_proposicoes)
+
+        self.assertEqual(Proposicao.objects.get(id=2190355).nome_processado, 'PL 1/2019')
+        self.assertEqual(Proposicao.objects.get(id=2190400).nome_processado, 'EMP 3 => PL 1/2019')
+        self.assertEqual(list(DadosAbertosArquivo.objects.values_list('year', 'row_count')), [(2019, 2)])
+
+        # Unchanged files are revalidated but not loaded again
+        Proposicao.objects.filter(id=2190355).update(ementa='')
+        self.load(dadosabertos.load_proposicoes)
+
+        self.assertEqual(Proposicao.objects.get(id=2190355).ementa, '')
+
+    def test_delete_proposicoes(self):
+        self.load(dadosabertos.load_proposicoes)
+
+        # A proposicao missing from the new version of its yearly file
+        proposicao = Proposicao.objects.create(id=2190500, nome_processado='PL 2/2019', data_apresentacao=datetime.date(2019, 5, 6))
+        proposicao.tema.add(Tema.objects.create(id=44, nome='Defesa e Segurança'))
+        ProposicaoAggregated.objects.create(proposicao=proposicao, date=datetime.date(2019, 5, 7), ficha_pageviews=3)
+        DadosAbertosArquivo.objects.update(checksum='')
+
+        # Loads run in their own transactions, without pending constraint checks
+        with connection.cursor() as cursor:
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+
+        self.load(dadosabertos.load_proposicoes)
+
+        self.assertFalse(Proposicao.objects.filter(id=2190500).exists())
+        self.assertFalse(ProposicaoAggregated.objects.filter(proposicao_id=2190500).exists())
+        self.assertFalse(Proposicao.tema.through.objects.filter(proposicao_id=2190500).exists())
+
+    def test_link_formularios_publicados(self):
+        self.load(dadosabertos.load_proposicoes)
+        self.assertIsNone(Proposicao.objects.get(id=2190355).formulario_publicado)
+
+        # Enquetes published after their proposicao are linked even though
+        # its yearly file is unchanged
+        formulario_publicado = EnqueteFormularioPublicado.objects.create(
+            ide_usuario='1', tex_url_formulario_publicado='2190355', nom_titulo_formulario_publicado='PL 1/2019',
+            cod_tipo='1', cod_divulgacao='1', dat_publicacao=datetime.datetime(2019, 3, 1),
+            dat_inicio_vigencia=datetime.datetime(2019, 3, 1), des_conteudo='')
+        formulario_publicado.enqueteresposta_set.create(ide_usuario='1', dat_resposta=datetime.datetime(2019, 3, 2, 10))
+        self.load(dadosabertos.load_proposicoes)
+
+        self.assertEqual(Proposicao.objects.get(id=2190355).formulario_publicado, formulario_publicado)
+        self.assertTrue(PreprocessDirtyDate.objects.filter(target='proposicoes', date=datetime.date(2019, 3, 2)).exists())
+
+    @override_settings(DATALOADER_SHADOW_TABLES=True)
+    def test_load_proposicoes_shadow_tables(self):
+        formulario_publicado = EnqueteFormularioPublicado.objects.create(
+            ide_usuario='1', tex_url_formulario_publicado='2190355', nom_titulo_formulario_publicado='PL 1/2019',
+            cod_tipo='1', cod_divulgacao='1', dat_publicacao=datetime.datetime(2019, 3, 1),
+            dat_inicio_vigencia=datetime.datetime(2019, 3, 1), des_conteudo='')
+
+        # Foreign keys are validated once the load commits
+        with self.captureOnCommitCallbacks(execute=True):
+            self.load(dadosabertos.load_proposicoes)
+
+        # Links are made in the shadow table, before it is swapped in
+        self.assertEqual(Proposicao.objects.get(id=2190355).formulario_publicado, formulario_publicado)
+
+        with connection.cursor() as cursor:
+            cursor.execute('''
+                SELECT conname FROM pg_constraint
+                WHERE contype = 'f' AND NOT convalidated AND (conrelid = 'app_proposicao'::regclass OR confrelid = 'app_proposicao'::regclass)
+            ''')
+            self.assertEqual(cursor.fetchall(), [])
+
+    def test_load_proposicoes_temas(self):
+        self.load(dadosabertos.load_proposicoes)
+        self.load(dadosabertos.load_proposicoes_temas)
+
+        self.assertEqual(sorted(Proposicao.objects.get(id=2190355).tema.values_list('id', 'nome')), [
+            (44, 'Defesa e Segurança'),
+            (62, 'Direitos Humanos e Minorias'),
+        ])
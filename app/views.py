@@ -343,7 +343,7 @@ def proposicao_detail(request, id_proposicao):
     poll_votes_plot = plots.poll_votes(proposicao)
 
     # Noticias
-    qs = proposicao.noticia_set.order_by('data').all()
+    qs = proposicao.noticia_set.order_by('data').only('data', 'titulo', 'link')
     stats.update({
         'noticias': [{
             'data': row.data.strftime(settings.STRFTIME_SHORT_DATE_FORMAT),
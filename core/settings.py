@@ -186,6 +186,65 @@ STRFTIME_SHORT_DATE_FORMAT_URL = '%d-%m-%Y'
 
 ANALYTICS_CREDENTIALS = os.environ['ANALYTICS_CREDENTIALS']
 
+# Google Analytics pageviews are queried in windows of up to this many days
+ANALYTICS_WINDOW_DAYS = int(os.environ.get('ANALYTICS_WINDOW_DAYS', default=31))
+
+# GA numbers of the last few days may still be incomplete, so this many trailing
+# days are re-fetched on every load even when they are already loaded
+ANALYTICS_RESYNC_DAYS = int(os.environ.get('ANALYTICS_RESYNC_DAYS', default=3))
+
+# Concurrent GA queries, and the rate they are limited to (GA allows 10 queries
+# per second per user)
+ANALYTICS_CONCURRENCY = int(os.environ.get('ANALYTICS_CONCURRENCY', default=4))
+ANALYTICS_REQUESTS_PER_SECOND = float(os.environ.get('ANALYTICS_REQUESTS_PER_SECOND', default=5))
+
+# Every GA response is archived here (gzip JSON lines, one file per query start
+# date), so pageviews can be rebuilt offline with dataloader --from-archive. Set
+# it to an empty string to disable the archive
+ANALYTICS_ARCHIVE_DIR = os.environ.get('ANALYTICS_ARCHIVE_DIR', default=os.path.join(BASE_DIR, 'archive', 'analytics'))
+
+# Number of rows fetched per query when copying tables from external sources
+DATALOADER_BATCH_SIZE = int(os.environ.get('DATALOADER_BATCH_SIZE', default=50000))
+
+# Tables copied at once (each on its own connections) by loaders that
+# replicate several source tables in parallel (prisma)
+DATALOADER_REPLICATION_WORKERS = int(os.environ.get('DATALOADER_REPLICATION_WORKERS', default=4))
+
+# Full reloads write into unlogged copies of the tables that are swapped in at
+# the end, instead of deleting and reinserting rows in the live tables
+DATALOADER_SHADOW_TABLES = os.environ.get('DATALOADER_SHADOW_TABLES', default=False) == 'True'
+
+# Loaders that sync incrementally (enquetes, prisma, comentarios portal) still reload their tables from
+# scratch when the last full reload is older than this many days
+DATALOADER_FULL_SYNC_DAYS = int(os.environ.get('DATALOADER_FULL_SYNC_DAYS', default=7))
+
+# Moderation fields of enquete posicionamentos posted in the last days are
+# synced again on incremental loads
+DATALOADER_ENQUETES_RESYNC_DAYS = int(os.environ.get('DATALOADER_ENQUETES_RESYNC_DAYS', default=30))
+
+# Comentarios portal posted in the last days that are still PENDENTE are
+# fetched again on incremental loads, so that moderation reaches them
+DATALOADER_COMENTARIOS_PENDING_DAYS = int(os.environ.get('DATALOADER_COMENTARIOS_PENDING_DAYS', default=30))
+
+# Dados abertos base URL (can point to a local server with fixture files) and
+# how many yearly files are downloaded (threads) and decoded (processes) at once
+DADOS_ABERTOS_URL = os.environ.get('DADOS_ABERTOS_URL', default='https://dadosabertos.camara.leg.br')
+DATALOADER_DOWNLOAD_WORKERS = int(os.environ.get('DATALOADER_DOWNLOAD_WORKERS', default=4))
+DATALOADER_PARSE_WORKERS = int(os.environ.get('DATALOADER_PARSE_WORKERS', default=2))
+
+# Noticias first seen in Google Analytics are fetched from the portal web service
+# on this many threads
+DATALOADER_NOTICIAS_WORKERS = int(os.environ.get('DATALOADER_NOTICIAS_WORKERS', default=8))
+
+# Noticias updated or most viewed in the last days are fetched again (at most
+# this many per run) so that later edits make it into the database
+DATALOADER_NOTICIAS_REFRESH_DAYS = int(os.environ.get('DATALOADER_NOTICIAS_REFRESH_DAYS', default=30))
+DATALOADER_NOTICIAS_REFRESH_LIMIT = int(os.environ.get('DATALOADER_NOTICIAS_REFRESH_LIMIT', default=1000))
+
+# Yearly dados abertos files are kept here and revalidated with conditional
+# requests (ETag/Last-Modified). Set it to an empty string to disable the cache
+DADOS_ABERTOS_CACHE_DIR = os.environ.get('DADOS_ABERTOS_CACHE_DIR', default=os.path.join(BASE_DIR, 'cache', 'dadosabertos'))
+
 CELERY_BROKER_URL = "redis://redis:6379"
 CELERY_RESULT_BACKEND = "redis://redis:6379"
 
@@ -198,6 +257,20 @@ if bool(os.environ.get('AUTO_DATALOADER', default=False)):
         "schedule": crontab(hour="5", minute="0"),
     }
 
+# Prisma is synced incrementally every this many minutes between the nightly
+# dataloader runs (0 disables it)
+DATALOADER_PRISMA_SYNC_MINUTES = int(os.environ.get('DATALOADER_PRISMA_SYNC_MINUTES', default=0))
+
+if bool(os.environ.get('AUTO_DATALOADER', default=False)) and DATALOADER_PRISMA_SYNC_MINUTES:
+    CELERY_BEAT_SCHEDULE["prisma_dataloader"] = {
+        "task": "core.tasks.prisma_dataloader_task",
+        "schedule": crontab(minute="*/%d" % (DATALOADER_PRISMA_SYNC_MINUTES,)),
+    }
+
+# Processes (rebuild_cache) or celery tasks (rebuild_cache --enqueue and the
+# nightly dataloader) warming the report caches at once
+CACHE_WARMING_CONCURRENCY = int(os.environ.get('CACHE_WARMING_CONCURRENCY', default=4))
+
 CACHES = {
     'default': {
         'BACKEND': 'django_redis.cache.RedisCache',
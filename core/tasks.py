@@ -12,9 +12,22 @@ def dataloader_task():
     dataloader.load_proposicoes()
     dataloader.load_proposicoes_autores()
     dataloader.load_proposicoes_temas()
-    dataloader.load_analytics_fichas()
-    dataloader.load_analytics_noticias()
+    dataloader.load_analytics()
+    dataloader.refresh_noticias()
     dataloader.preprocess_daily_summary()
     dataloader.preprocess_proposicoes()
     dataloader.preprocess_noticias()
-    cache.rebuild_caches()
+    cache.enqueue_rebuild_caches()
+
+@shared_task
+def prisma_dataloader_task():
+    dataloader.load_prisma()
+    dataloader.preprocess_daily_summary()
+
+@shared_task
+def warm_cache_periods_task(periods):
+    return cache.warm_cache_periods(periods)
+
+@shared_task
+def rebuild_caches_done_task(results, started_at):
+    cache.report_rebuild(started_at, [period for failed in results for period in failed])